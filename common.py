@@ -9,21 +9,26 @@ __docformat__ = "markdown en"
 # Be careful editing this! This file has to work in multiple packages at once,
 # so don't import anything from calibre_plugins
 
+import hashlib
+import json
 import os
 import re
+import shutil
 import sys
+import threading
 import time
 import traceback
+import zipfile
+from collections import defaultdict
 from functools import partial
 
 from calibre import prints
 from calibre.constants import config_dir
+from calibre.constants import numeric_version
 from calibre.constants import preferred_encoding
 from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.book.base import NULL_VALUES
 from calibre.ebooks.oeb.polish.container import EpubContainer
-from calibre.ebooks.oeb.polish.container import OPF_NAMESPACES
-from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils.logging import ANSIStream
 from polyglot.builtins import is_py3
 from polyglot.io import PolyglotStringIO
@@ -31,9 +36,11 @@ from polyglot.io import PolyglotStringIO
 from lxml.etree import _Element
 
 if is_py3:
+    from typing import Any
     from typing import Dict
     from typing import List
     from typing import Optional
+    from typing import Tuple
     from typing import Union
 
 KOBO_JS_RE = re.compile(r".*/?kobo.*?\.js$", re.IGNORECASE)
@@ -42,6 +49,10 @@ CONFIGDIR = os.path.join(config_dir, "plugins")
 REFERENCE_KEPUB = os.path.join(CONFIGDIR, "reference.kepub.epub")
 PLUGIN_VERSION = (3, 5, 1)
 PLUGIN_MINIMUM_CALIBRE_VERSION = (5, 0, 0)
+# Converted books are cached here, and the least recently used are removed once
+# the cache holds more than CONVERSION_CACHE_LIMIT bytes.
+CONVERSION_CACHE_DIR = os.path.join(CONFIGDIR, "kobotouch_extended_cache")
+CONVERSION_CACHE_LIMIT = 1024 * 1024 * 1024
 
 
 class Logger:
@@ -104,6 +115,195 @@ class Logger:
 log = Logger()
 
 
+def file_hash(path: str) -> str:
+    """Get the SHA-256 hash of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(partial(f.read, 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AssetCache:
+    """The files added to every converted book, loaded once per process.
+
+    This holds the kobo.js from the reference KePub, which is extracted again
+    only when the reference KePub changes, and the plugin's CSS files, with the
+    hyphenation CSS rendered once for each set of hyphenation options.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        # The mtime and size of the reference KePub, its hash, and its kobo.js
+        self.__reference_stat: Optional[Tuple[int, int]] = None
+        self.__reference_hash = ""
+        self.__kobo_js: Optional[bytes] = None
+        self.__resources: Dict[str, bytes] = {}
+        self.__hyphenation_css: Dict[Tuple[Any, ...], bytes] = {}
+
+    def kobo_js(self) -> Optional[bytes]:
+        """Get the kobo.js from the reference KePub, if there is one."""
+        with self.__lock:
+            try:
+                stat = os.stat(REFERENCE_KEPUB)
+            except OSError:
+                self.__reference_stat = None
+                self.__reference_hash = ""
+                self.__kobo_js = None
+                return None
+
+            reference_stat = (stat.st_mtime_ns, stat.st_size)
+            if reference_stat == self.__reference_stat:
+                return self.__kobo_js
+            # Touching the reference KePub doesn't mean it changed
+            reference_hash = file_hash(REFERENCE_KEPUB)
+            self.__reference_stat = reference_stat
+            if reference_hash != self.__reference_hash:
+                self.__reference_hash = reference_hash
+                self.__kobo_js = self.__extract_kobo_js()
+            return self.__kobo_js
+
+    def kobo_js_hash(self) -> str:
+        """Get the SHA-256 hash of the kobo.js from the reference KePub, if any."""
+        kobo_js = self.kobo_js()
+        return hashlib.sha256(kobo_js).hexdigest() if kobo_js is not None else ""
+
+    def resource(self, path: str) -> bytes:
+        """Get a file from the plugin."""
+        with self.__lock:
+            data = self.__resources.get(path)
+            if data is None:
+                data = self.__resources[path] = get_resources(path)
+            return data
+
+    def hyphenation_css(
+        self,
+        min_chars: Any,
+        min_chars_before: Any,
+        min_chars_after: Any,
+        limit_lines: Any,
+    ) -> bytes:
+        """Get the hyphenation CSS for the given hyphenation options."""
+        options = (min_chars, min_chars_before, min_chars_after, limit_lines)
+        with self.__lock:
+            css = self.__hyphenation_css.get(options)
+        if css is None:
+            css_template = self.resource("css/hyphenation.css.tmpl").decode()
+            css = css_template.format(
+                hyphen_min_chars=min_chars,
+                hyphen_min_chars_before=min_chars_before,
+                hyphen_min_chars_after=min_chars_after,
+                hyphen_limit_lines=limit_lines,
+            ).encode()
+            with self.__lock:
+                self.__hyphenation_css[options] = css
+        return css
+
+    def __extract_kobo_js(self) -> Optional[bytes]:
+        with zipfile.ZipFile(REFERENCE_KEPUB) as zf:
+            for name in zf.namelist():
+                if KOBO_JS_RE.match(name):
+                    return zf.read(name)
+        return None
+
+
+assets = AssetCache()
+
+
+def reference_kobo_js_hash() -> str:
+    """Get the SHA-256 hash of the kobo.js in the reference KePub, if any."""
+    return assets.kobo_js_hash()
+
+
+class ConversionCache:
+    """An on-disk cache of converted books.
+
+    Entries are converted ePub files named by a key (see key()) made from
+    everything the conversion depends on. Using an entry marks it as recently
+    used, and the least recently used entries are removed once the cache holds
+    more than limit bytes. The stats counters hold the number of hits, misses,
+    stored entries and evictions since they were last reset.
+    """
+
+    def __init__(
+        self, path: str = CONVERSION_CACHE_DIR, limit: int = CONVERSION_CACHE_LIMIT
+    ) -> None:
+        self.path = path
+        self.limit = limit
+        self.stats = defaultdict(int)  # type: Dict[str, int]
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def key(source: str, options: Dict[str, Any]) -> str:
+        """Get the cache key of converting the ePub at source with options.
+
+        The key covers the source file, the options, the plugin and calibre
+        versions, and the kobo.js from the reference KePub, which is added to
+        converted books.
+        """
+        digest = hashlib.sha256()
+        digest.update(repr(PLUGIN_VERSION).encode("UTF-8"))
+        digest.update(repr(numeric_version).encode("UTF-8"))
+        digest.update(json.dumps(options, sort_keys=True).encode("UTF-8"))
+        digest.update(reference_kobo_js_hash().encode("UTF-8"))
+        digest.update(file_hash(source).encode("UTF-8"))
+        return digest.hexdigest()
+
+    def fetch(self, key: str, dest: str) -> bool:
+        """Replace dest with the cached book for key, if there is one."""
+        entry = self.__entry(key)
+        with self.__lock:
+            if not os.path.isfile(entry):
+                self.stats["misses"] += 1
+                return False
+            os.utime(entry)
+            self.stats["hits"] += 1
+        self.__copy(entry, dest)
+        return True
+
+    def store(self, key: str, source: str) -> None:
+        """Cache the converted book at source under key."""
+        os.makedirs(self.path, exist_ok=True)
+        self.__copy(source, self.__entry(key))
+        with self.__lock:
+            self.stats["stores"] += 1
+            self.__evict()
+
+    def reset_stats(self) -> None:
+        """Start counting hits, misses, stores and evictions from zero."""
+        with self.__lock:
+            self.stats.clear()
+
+    def clear(self) -> None:
+        """Remove every cached book."""
+        with self.__lock:
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    def __entry(self, key: str) -> str:
+        return os.path.join(self.path, f"{key}.epub")
+
+    def __copy(self, source: str, dest: str) -> None:
+        """Copy a file so that dest is never left partially written."""
+        tmp = f"{dest}.tmp"
+        shutil.copyfile(source, tmp)
+        os.replace(tmp, dest)
+
+    def __evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(".epub"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in entries:
+            if total <= self.limit:
+                break
+            os.remove(path)
+            total -= size
+            self.stats["evictions"] += 1
+
+
 # The logic here to detect a cover image is mostly duplicated from
 # metadata/writer.py. Updates to the logic here probably need an accompanying
 # update over there.
@@ -112,35 +312,31 @@ def modify_epub(
     filename: str,
     metadata: Optional[Metadata] = None,
     opts: Dict[str, Union[str, bool]] = {},
+    commit: bool = True,
 ) -> None:
-    """Modify the ePub file to make it KePub-compliant."""
+    """Modify the ePub file to make it KePub-compliant.
+
+    If commit is False the container is not written to filename, so callers
+    making more changes to it can write the book once when they are done.
+    """
     _modify_start = time.time()
 
     # Search for the ePub cover
     # TODO: Refactor out cover detection logic so it can be directly used in
     # metadata/writer.py
     found_cover = False
-    opf: _Element = container.opf
-    cover_meta_node_list: List[_Element] = opf.xpath(
-        './opf:metadata/opf:meta[@name="cover"]', namespaces=OPF_NAMESPACES
-    )
+    manifest = container.manifest_index()
 
-    if len(cover_meta_node_list) > 0:
-        cover_meta_node: _Element = cover_meta_node_list[0]
-        cover_id = cover_meta_node.attrib.get("content", None)
+    if manifest.cover_id is not None:
+        cover_id = manifest.cover_id
 
         log.debug("Found meta node with name=cover")
 
         if cover_id:
             log.info("Found cover image ID '{0}'".format(cover_id))
 
-            cover_node_list: _Element = opf.xpath(
-                './opf:manifest/opf:item[@id="{0}"]'.format(cover_id),
-                namespaces=OPF_NAMESPACES,
-            )
-            if len(cover_node_list) > 0:
-                cover_node: _Element = cover_node_list[0]
-
+            cover_node = manifest.by_id.get(cover_id)
+            if cover_node is not None:
                 log.debug("Found an item node with cover ID")
 
                 if cover_node.attrib.get("properties", "") != "cover-image":
@@ -156,14 +352,7 @@ def modify_epub(
     if not found_cover:
         log.debug("Looking for cover image in OPF manifest")
 
-        node_list: List[_Element] = opf.xpath(
-            "./opf:manifest/opf:item[(translate(@id, "
-            + "'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
-            + '="cover" or starts-with(translate(@id, '
-            + "'ABCDEFGHIJKLMNOPQRSTUVWXYZ', 'abcdefghijklmnopqrstuvwxyz')"
-            + ', "cover")) and starts-with(@media-type, "image")]',
-            namespaces=OPF_NAMESPACES,
-        )
+        node_list: List[_Element] = manifest.cover_candidates
         if len(node_list) > 0:
             log.info(
                 f"Found {len(node_list)} nodes, assuming the first is the right node"
@@ -178,51 +367,43 @@ def modify_epub(
                 log.warning("Item node is already set as cover-image")
             found_cover = True
 
+    # Content passes are queued in the order they should run and then run
+    # together, so each content file only goes through one parse/serialize
+    # cycle for all of them. The files referenced from every content file are
+    # collected and added in a single pass, in order.
+    references: List[str] = []
     # Hyphenate files?
     if opts.get("no-hyphens", False):
-        nohyphen_css = PersistentTemporaryFile(suffix="_nohyphen", prefix="kepub_")
-        nohyphen_css.write(get_resources("css/no-hyphens.css"))
-        nohyphen_css.close()
-
         css_path = os.path.basename(
-            container.copy_file_to_container(
-                nohyphen_css.name, name="kte-css/no-hyphens.css"
+            container.copy_data_to_container(
+                assets.resource("css/no-hyphens.css"), "kte-css/no-hyphens.css"
             )
         )
-        container.add_content_file_reference("kte-css/{0}".format(css_path))
-        os.unlink(nohyphen_css.name)
+        references.append("kte-css/{0}".format(css_path))
     elif opts.get("hyphenate", False) and int(opts.get("hyphen_min_chars", 6)) > 0:
         if metadata and metadata.language == NULL_VALUES["language"]:
             log.warning(
                 "Hyphenation is enabled but not overriding content file "
                 + "language. Hyphenation may use the wrong dictionary."
             )
-        hyphen_css = PersistentTemporaryFile(suffix="_hyphenate", prefix="kepub_")
-        css_template = get_resources("css/hyphenation.css.tmpl").decode()
         hyphen_limit_lines = opts.get("hyphen_limit_lines", 2)
         if hyphen_limit_lines == 0:
             hyphen_limit_lines = "no-limit"
-        hyphen_css.write(
-            css_template.format(
-                hyphen_min_chars=opts.get("hyphen_min_chars"),
-                hyphen_min_chars_before=opts.get("hyphen_min_chars_before", 3),
-                hyphen_min_chars_after=opts.get("hyphen_min_chars_after", 3),
-                hyphen_limit_lines=hyphen_limit_lines,
-            ).encode()
+        hyphen_css = assets.hyphenation_css(
+            opts.get("hyphen_min_chars"),
+            opts.get("hyphen_min_chars_before", 3),
+            opts.get("hyphen_min_chars_after", 3),
+            hyphen_limit_lines,
         )
-        hyphen_css.close()
 
         css_path = os.path.basename(
-            container.copy_file_to_container(
-                hyphen_css.name, name="kte-css/hyphenation.css"
-            )
+            container.copy_data_to_container(hyphen_css, "kte-css/hyphenation.css")
         )
-        container.add_content_file_reference("kte-css/{0}".format(css_path))
-        os.unlink(hyphen_css.name)
+        references.append("kte-css/{0}".format(css_path))
 
     # Now smarten punctuation
     if opts.get("smarten_punctuation", False):
-        container.smarten_punctuation()
+        container.queue_content_pass("smarten_punctuation")
 
     if opts.get("extended_kepub_features", True):
         if metadata is not None:
@@ -233,7 +414,8 @@ def modify_epub(
             )
 
         # Add the Kobo span and div tags
-        container.convert()
+        container.queue_content_pass("add_kobo_spans")
+        container.queue_content_pass("add_kobo_divs")
 
         # Check to see if there's already a kobo*.js in the ePub
         skip_js = False
@@ -242,33 +424,31 @@ def modify_epub(
                 skip_js = True
                 break
 
-        if not skip_js:
-            if os.path.isfile(REFERENCE_KEPUB):
-                reference_container = EpubContainer(REFERENCE_KEPUB, log)
-                for name in reference_container.name_path_map:
-                    if KOBO_JS_RE.match(name):
-                        jsname = container.copy_file_to_container(
-                            os.path.join(reference_container.root, name), name="kobo.js"
-                        )
-                        container.add_content_file_reference(jsname)
-                        break
+        kobo_js = None if skip_js else assets.kobo_js()
+        if kobo_js is not None:
+            jsname = container.copy_data_to_container(kobo_js, "kobo.js")
+            references.append(jsname)
 
         # Add the Kobo style hacks
-        stylehacks_css = PersistentTemporaryFile(suffix="_stylehacks", prefix="kepub_")
-        stylehacks_css.write(get_resources("css/style-hacks.css"))
-        stylehacks_css.close()
-
         css_path = os.path.basename(
-            container.copy_file_to_container(
-                stylehacks_css.name, name="kte-css/stylehacks.css"
+            container.copy_data_to_container(
+                assets.resource("css/style-hacks.css"), "kte-css/stylehacks.css"
             )
         )
-        container.add_content_file_reference("kte-css/{0}".format(css_path))
-    os.unlink(filename)
-    container.commit(filename)
+        references.append("kte-css/{0}".format(css_path))
+
+    if references:
+        container.queue_content_pass("add_content_file_reference", *references)
+    container.run_content_passes()
+    if commit:
+        os.unlink(filename)
+        container.commit(filename)
 
     _modify_time = time.time() - _modify_start
     log.info("modify_epub took {0:f} seconds".format(_modify_time))
+    log.debug(
+        "modify_epub serialized {0} files".format(container.stats["serializations"])
+    )
 
 
 def intValueChanged(widget, singular, plural, *args, **kwargs):
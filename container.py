@@ -12,26 +12,59 @@ __docformat__ = "restructuredtext en"
 # Be careful editing this! This file has to work in multiple plugins at once,
 # so don't import anything from calibre_plugins.
 
+import hashlib
+import math
+import multiprocessing
 import os
 import re
 import shutil
 import string
+import struct
+import sys
+import threading
+import time
+import unicodedata
+import zipfile
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
 from collections import defaultdict
+from collections import deque
+from concurrent.futures import ALL_COMPLETED
+from concurrent.futures import Executor
 from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
 from concurrent.futures import ThreadPoolExecutor
-from copy import deepcopy
+from concurrent.futures import TimeoutError
+from concurrent.futures import wait
+from io import BytesIO
+from typing import Any
+from typing import BinaryIO
 from typing import Callable
+from typing import Deque
 from typing import Dict
+from typing import Iterable
 from typing import Iterator
 from typing import List
 from typing import Optional
+from typing import Set
 from typing import Tuple
+from typing import Union
+from urllib.parse import unquote
 
 from calibre import guess_type
 from calibre.ebooks.conversion.plugins.epub_input import ADOBE_OBFUSCATION
 from calibre.ebooks.conversion.plugins.epub_input import IDPF_OBFUSCATION
 from calibre.ebooks.conversion.utils import HeuristicProcessor
+from calibre.ebooks.oeb.base import OEB_DOCS
+from calibre.ebooks.oeb.base import OEB_STYLES
+from calibre.ebooks.oeb.base import serialize
+from calibre.ebooks.oeb.polish.container import ContainerBase
 from calibre.ebooks.oeb.polish.container import EpubContainer
+from calibre.ebooks.oeb.polish.container import OPF_NAMESPACES
+from calibre.ebooks.oeb.polish.container import decrypt_font_data
+from calibre.ptempfile import PersistentTemporaryDirectory
+from calibre.utils.logging import default_log
 from calibre.utils.smartypants import smartyPants
 
 from lxml import etree
@@ -73,7 +106,44 @@ SKIPPED_TAGS = frozenset(
     ]
 )
 SPECIAL_TAGS = frozenset(["img"])
+# Elements which must be written self-closing when empty.
+VOID_TAGS = frozenset(
+    [
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "param",
+        "source",
+        "track",
+        "wbr",
+    ]
+)
+# How the span walker handles each tag: skipped tags are left alone, wrapped tags
+# get wrapped in a span and their children are ignored, and all other tags get
+# their content converted to spans.
+TAG_SKIP = "skip"
+TAG_WRAP = "wrap"
+TAG_DESCEND = "descend"
+TAG_NAME_RE = re.compile(r"^(?:\{[^\}]+\})?(\w+)$")
 ENCODING_RE = re.compile(r'^\<\?.+encoding="([^"]+)"', re.MULTILINE)
+XML_DECLARATION_RE = re.compile(r"^\s*<\?xml[^>]*\?>")
+# Entity references other than those predefined by XML, which calibre parses as
+# HTML, and the start tag of an html element
+UNSTREAMABLE_ENTITY_RE = re.compile(
+    rb"&(?!(?:amp|lt|gt|quot|apos|#[0-9]+|#x[0-9a-fA-F]+);)"
+)
+HTML_START_TAG_RE = re.compile(rb"<(?:[^\s/>!?:]+:)?html[\s/>]")
+# The namespace declarations lxml writes on an element serialized on its own
+STREAM_NAMESPACE_DECLARATIONS_RE = re.compile(
+    rb'^(<[^\s/>]+)(?: xmlns(?::[^\s=]+)?="[^"]*")+'
+)
 SELF_CLOSING_RE = re.compile(
     r"<(meta|link) ([^>]+)>.*?</\1>", re.UNICODE | re.MULTILINE
 )
@@ -86,6 +156,102 @@ TEXT_SPLIT_RE = re.compile(
     r'(\s*.*?[\.\!\?\:][\'"\u201c\u201d\u2018\u2019\u2026]?\s*)',
     re.UNICODE | re.MULTILINE,
 )
+# Characters ending a sentence, and the closing quotes a sentence may end with.
+SENTENCE_TERMINATORS = ".!?:"
+SENTENCE_CLOSERS = "'\"\u201c\u201d\u2018\u2019\u2026"
+CJK_SENTENCE_TERMINATORS = SENTENCE_TERMINATORS + "\u3002\uff01\uff1f\uff1a"
+CJK_SENTENCE_CLOSERS = SENTENCE_CLOSERS + "\u300d\u300f\uff09\u300b\u3011"
+OPENING_PUNCTUATION = "([{\"'\u201c\u2018\u00ab"
+# Abbreviations which don't end a sentence, by language, in lower case. Periods
+# inside an abbreviation never end a sentence for a known language.
+SENTENCE_ABBREVIATIONS = {
+    "de": ["bzw.", "ca.", "d.h.", "dr.", "evtl.", "ggf.", "hr.", "nr.", "prof."]
+    + ["str.", "u.a.", "usw.", "vgl.", "z.b."],
+    "en": ["capt.", "cf.", "col.", "dr.", "e.g.", "gen.", "i.e.", "jr.", "lt."]
+    + ["mr.", "mrs.", "ms.", "mt.", "prof.", "rev.", "sgt.", "sr.", "st.", "vs."],
+    "es": ["dr.", "dra.", "p.ej.", "sr.", "sra.", "srta.", "ud.", "uds."],
+    "fr": ["av.", "cf.", "dr.", "m.", "mlle.", "mme.", "p.ex."],
+    "it": ["avv.", "dott.", "ing.", "prof.", "sig."],
+    "nl": ["bijv.", "blz.", "dhr.", "dr.", "m.b.t.", "mevr.", "o.a."],
+}  # type: Dict[str, List[str]]
+# Languages written without spaces between sentences.
+CJK_LANGUAGES = frozenset(["ja", "zh"])
+# ISO 639-2 codes of the languages with their own sentence segmenter.
+SEGMENTER_LANGUAGE_ALIASES = {
+    "chi": "zh",
+    "deu": "de",
+    "dut": "nl",
+    "eng": "en",
+    "fra": "fr",
+    "fre": "fr",
+    "ger": "de",
+    "ita": "it",
+    "jpn": "ja",
+    "nld": "nl",
+    "spa": "es",
+    "zho": "zh",
+}
+# Content passes operating on the decoded source text of a content file. These
+# always run before any tree pass when content passes are fused.
+TEXT_PASSES = frozenset(["forced_cleanup", "clean_markup", "smarten_punctuation"])
+# Content passes operating on the parsed tree of a content file.
+TREE_PASSES = frozenset(
+    ["add_content_file_reference", "add_kobo_spans", "add_kobo_divs"]
+)
+# Executor backends used to run work over content files. The serial backend runs
+# everything in the calling thread, the thread backend uses a thread pool, and
+# the process backend runs queued content passes in worker processes (other
+# work still uses the thread pool).
+EXECUTOR_SERIAL = "serial"
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+EXECUTORS = frozenset([EXECUTOR_SERIAL, EXECUTOR_THREAD, EXECUTOR_PROCESS])
+# Time budget, in seconds, for processing any one content file plus the extra
+# time allowed for each MiB of content. A task only uses its budget once a
+# worker starts running it, and only for its share of the time its worker runs
+# while tasks compete for the GIL or the CPUs.
+TASK_TIME_BUDGET = 10.0
+TASK_TIME_BUDGET_PER_MB = 20.0
+# How often, in seconds, running tasks are checked against their time budget.
+TASK_POLL_INTERVAL = 0.25
+# The thread pool never shrinks below this many workers.
+MIN_THREAD_WORKERS = 2
+# The default cap, in bytes, on the estimated memory used by the parsed trees of
+# content files which are kept cached after being written. A parsed tree is
+# estimated to use PARSED_TREE_SIZE_FACTOR times the size of its file.
+PARSED_CACHE_LIMIT = 256 * 1024 * 1024
+PARSED_TREE_SIZE_FACTOR = 20
+# Container backends: the disk backend extracts the ePub to a temporary directory
+# like calibre does, the memory backend keeps the files of the ePub in memory.
+BACKEND_DISK = "disk"
+BACKEND_MEMORY = "memory"
+BACKENDS = frozenset([BACKEND_DISK, BACKEND_MEMORY])
+EPUB_MIMETYPE = b"application/epub+zip"
+# Compression policies for the files written when committing a container, giving
+# the zlib level used for each kind of file (see classify_media_type()). Level 0
+# stores files uncompressed: images, audio, video and fonts are mostly
+# compressed already, so deflating them again costs time for almost no gain.
+COMPRESSION_DEFAULT = "default"
+COMPRESSION_POLICIES: Dict[str, Dict[str, int]] = {
+    COMPRESSION_DEFAULT: {"markup": 6, "media": 6, "font": 6, "other": 6},
+    "balanced": {"markup": 6, "media": 0, "font": 0, "other": 6},
+    "fast": {"markup": 1, "media": 0, "font": 0, "other": 1},
+    "smallest": {"markup": 9, "media": 9, "font": 9, "other": 9},
+}
+# Local file header signature and flag bit marking a trailing data descriptor
+# (PKWARE APPNOTE 4.3.7 and 4.4.4), used when copying archive members as-is.
+ZIP_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+# The Python versions whose zipfile internals _write_raw_member relies on
+RAW_MEMBER_PYTHON_VERSIONS = ((3, 6), (3, 13))
+# Content files larger than this many bytes have their content passes run while
+# they are parsed and written incrementally, instead of on a fully parsed tree.
+STREAMING_THRESHOLD = 16 * 1024 * 1024
+# Lower cases ASCII letters only, like XPath translate() calls used to
+ASCII_LOWERCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+# The default cap, in bytes, on the converted content files kept by a
+# TransformCache.
+TRANSFORM_CACHE_LIMIT = 64 * 1024 * 1024
 
 
 # TODO: Refactor InvalidEpub from here and device/driver.py to be a common class
@@ -105,31 +271,1190 @@ class ParseError(ValueError):
         ValueError.__init__(self, f"Failed to parse: {name} with error: {desc}")
 
 
+class ContentFileContext:
+    """The state of converting a single content file.
+
+    Only one thread at a time works on any content file, so the context of a
+    file needs no locking.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        # The parsed tree of the file while content passes run over it
+        self.root = None  # type: Optional[etree._Element]
+        # The number of the next paragraph to get Kobo spans
+        self.paragraph = 1
+        # The sentences of every text in the file while Kobo spans are added
+        self.segments = {}  # type: Dict[str, List[str]]
+        # The element counts of root (see _census_tree()) while content passes
+        # run over it
+        self.census = None  # type: Optional[Dict[str, int]]
+
+
+class StreamFrame:
+    """An element which is open while a content file is streamed.
+
+    The element start tag is written along with its first content. Its
+    children are written once complete, one at a time, and then dropped from
+    the tree; a child is only complete once the next one starts, or the
+    element ends, as its tail is parsed along with what follows it.
+    """
+
+    def __init__(self, node: etree._Element, spans: bool) -> None:
+        self.node = node
+        # Whether Kobo spans are added to the text of the element and children
+        self.spans = spans
+        # Whether the element text has been written
+        self.started = False
+        # The last child seen and whether it has been written already
+        self.pending = None  # type: Optional[etree._Element]
+        self.pending_written = False
+        # Whether the tail of the last child is kept
+        self.pending_tail = True
+        # Whether the tail of the element itself is kept
+        self.keep_tail = True
+        # The files still to be referenced from the head of the root element,
+        # and whether any reference was added
+        self.references = []  # type: List[str]
+        self.referenced = False
+        # The start tags of the element and its wrapping divs, outermost first,
+        # and whether they have been written
+        self.start_tags = []  # type: List[bytes]
+        self.opened = False
+        # The innermost wrapping div as written if it stays empty
+        self.empty_div = b""
+
+
+class StreamWriter:
+    """Writes a streamed content file as calibre serializes the whole tree.
+
+    Elements, comments and Kobo spans are serialized by calibre while they are
+    in the streamed tree. lxml declares the namespaces in scope on any element
+    serialized on its own; only the root of a streamed file declares
+    namespaces (see _stream_fallback_reason()), so these are dropped again.
+    """
+
+    def __init__(self, media_type: Optional[str]) -> None:
+        self.media_type = media_type
+        self.out = BytesIO()
+
+    def write(self, data: bytes) -> None:
+        self.out.write(data)
+
+    def write_text(self, text: str) -> None:
+        """Write text, escaped as libxml2 does."""
+        self.out.write(
+            text.replace("&", "&amp;")
+            .replace("<", "&lt;")
+            .replace(">", "&gt;")
+            .replace("\r", "&#13;")
+            .encode("utf-8")
+        )
+
+    def write_declaration(self, root: etree._Element) -> bytes:
+        """Write the XML declaration, and get the start tag of the root."""
+        data = serialize(root, self.media_type)
+        start = data.index(b"<", data.index(b"?>"))
+        self.out.write(data[:start])
+        return _start_tag(data[start:])
+
+    def serialize(self, node: etree._Element) -> bytes:
+        """Serialize a node in the streamed tree, without its tail."""
+        tail = node.tail
+        node.tail = None
+        try:
+            if isinstance(node.tag, str):
+                data = serialize(node, self.media_type)
+                start = data.index(b"<", data.index(b"?>"))
+                return STREAM_NAMESPACE_DECLARATIONS_RE.sub(
+                    rb"\1", data[start:], count=1
+                )
+            # calibre's serialize() only takes elements, but changes the
+            # content of comments too, so these are serialized inside one. This
+            # detaches the node.
+            wrapper = etree.Element(f"{{{XHTML_NAMESPACE}}}span")
+            wrapper.append(node)
+            return self.serialize_content(wrapper)
+        finally:
+            node.tail = tail
+
+    def serialize_content(self, node: etree._Element) -> bytes:
+        """Serialize the text and children of an element in the streamed tree."""
+        data = self.serialize(node)
+        start = data.index(b">") + 1
+        end = data.rindex(b"</")
+        return data[start:end]
+
+    def start_tag(self, node: etree._Element) -> bytes:
+        """Get the start tag of an element in the streamed tree, without ">"."""
+        return _start_tag(self.serialize(node))
+
+    def getvalue(self) -> bytes:
+        return self.out.getvalue()
+
+
+class SentenceSegmenter:
+    """Splits text into the sentences which each get their own Kobo span.
+
+    A sentence runs up to the first terminator on its line, which may be
+    followed by a closing quote, and includes the whitespace around it. Text
+    after the last sentence on a line stays in its own segment. Without any
+    abbreviations or inner_terminators set to False this gives the same
+    segments as splitting with TEXT_SPLIT_RE, but in linear time: the regular
+    expression backtracks over every position of a long line without a
+    terminator.
+
+    Periods ending one of the given lower case abbreviations don't end a
+    sentence. If inner_terminators is False, neither do SENTENCE_TERMINATORS
+    directly followed by a letter or digit, as in "3.14", "e.g." or "10:30".
+    """
+
+    def __init__(
+        self,
+        terminators: str = SENTENCE_TERMINATORS,
+        closers: str = SENTENCE_CLOSERS,
+        abbreviations: Iterable[str] = (),
+        inner_terminators: bool = True,
+    ) -> None:
+        self.__terminator_re = re.compile(f"[{re.escape(terminators)}]")
+        self.__closer_re = re.compile(f"[{re.escape(closers)}]?\\s*")
+        self.__abbreviations = frozenset(abbreviations)
+        self.__abbreviation_length = max(map(len, self.__abbreviations), default=0)
+        self.__inner_terminators = inner_terminators
+
+    def split(self, text: str) -> List[str]:
+        """Split text into sentences, dropping empty segments."""
+        return self.split_texts([text])[0]
+
+    def split_texts(self, texts: List[str]) -> List[List[str]]:
+        """Split each of the texts into sentences, dropping empty segments.
+
+        All texts are searched for terminators at once, in a single buffer
+        with the offset of each text, so the many texts without any
+        terminator are never searched on their own.
+        """
+        buffer = "\0".join(texts)
+        terminators = [match.start() for match in self.__terminator_re.finditer(buffer)]
+
+        groups = []
+        first = 0
+        offset = 0
+        for text in texts:
+            end = offset + len(text)
+            last = bisect_left(terminators, end, first)
+            if last == first:
+                # Fast path for the many short text nodes without a sentence end
+                groups.append([text] if text else [])
+            else:
+                groups.append(
+                    self.__split(text, [t - offset for t in terminators[first:last]])
+                )
+            first = last
+            # Skip the separator
+            offset = end + 1
+
+        return groups
+
+    def __split(self, text: str, terminators: List[int]) -> List[str]:
+        groups = []
+        pos = 0
+        for terminator in terminators:
+            if terminator < pos or not self.__ends_sentence(text, terminator):
+                continue
+
+            # A sentence starts on the line of its terminator, along with the
+            # whitespace right before that line
+            start = text.rfind("\n", pos, terminator) + 1
+            if start > pos:
+                while start > pos and text[start - 1].isspace():
+                    start -= 1
+            else:
+                start = pos
+            end = self.__closer_re.match(text, terminator + 1).end()
+
+            if start > pos:
+                groups.append(text[pos:start])
+            groups.append(text[start:end])
+            pos = end
+
+        if pos < len(text):
+            groups.append(text[pos:])
+        return groups
+
+    def __ends_sentence(self, text: str, index: int) -> bool:
+        if not self.__inner_terminators and index + 1 < len(text):
+            # Full width terminators are never followed by a space
+            if text[index] in SENTENCE_TERMINATORS and text[index + 1].isalnum():
+                return False
+
+        if self.__abbreviations and text[index] == ".":
+            # Only look back as far as the longest abbreviation, so that long
+            # runs of periods stay linear
+            start = max(0, index - self.__abbreviation_length)
+            words = (text[start:index] + ".").split()
+            word = words[-1].lstrip(OPENING_PUNCTUATION).lower() if words else ""
+            if word in self.__abbreviations:
+                return False
+
+        return True
+
+
+DEFAULT_SEGMENTER = SentenceSegmenter()
+SEGMENTERS = {
+    language: SentenceSegmenter(abbreviations=abbreviations, inner_terminators=False)
+    for language, abbreviations in SENTENCE_ABBREVIATIONS.items()
+}  # type: Dict[str, SentenceSegmenter]
+SEGMENTERS.update(
+    {
+        language: SentenceSegmenter(
+            CJK_SENTENCE_TERMINATORS, CJK_SENTENCE_CLOSERS, inner_terminators=False
+        )
+        for language in CJK_LANGUAGES
+    }
+)
+
+
+def segmenter_for_language(language: Optional[str]) -> SentenceSegmenter:
+    """Get the sentence segmenter for a BCP 47 or ISO 639-2 language code.
+
+    Languages without their own segmenter use DEFAULT_SEGMENTER.
+    """
+    if not language:
+        return DEFAULT_SEGMENTER
+    language = re.split(r"[-_]", language.strip().lower())[0]
+    language = SEGMENTER_LANGUAGE_ALIASES.get(language, language)
+    return SEGMENTERS.get(language, DEFAULT_SEGMENTER)
+
+
+class ManifestIndex:
+    """An index of the manifest and spine of an OPF document.
+
+    The index is built once from the OPF root element and holds the manifest
+    items themselves, so changes to their attributes are seen, but a new index
+    must be built when items are added or removed. Names are item hrefs made
+    relative to the directory containing the OPF document.
+    """
+
+    def __init__(self, opf: etree._Element, opf_name: str = "") -> None:
+        self.opf = opf
+        # Manifest items in manifest order, by ID and by href
+        self.items = []  # type: List[etree._Element]
+        self.by_id = {}  # type: Dict[str, etree._Element]
+        self.by_href = {}  # type: Dict[str, etree._Element]
+        # The media type of each named item, in manifest order, and the names
+        # of the items of each media type
+        self.media_types = OrderedDict()  # type: OrderedDict[str, str]
+        self.by_media_type = defaultdict(list)  # type: Dict[str, List[str]]
+        # Item names in spine order
+        self.spine = []  # type: List[str]
+        # The ID given by the cover <meta> element, if there is one, and the
+        # images whose ID starts with "cover", ignoring case
+        self.cover_id = None  # type: Optional[str]
+        self.cover_candidates = []  # type: List[etree._Element]
+
+        base = os.path.dirname(opf_name)
+        names = {}  # type: Dict[str, str]
+        for item in opf.xpath("//opf:manifest/opf:item", namespaces=OPF_NAMESPACES):
+            self.items.append(item)
+            item_id = item.get("id")
+            href = item.get("href")
+            media_type = item.get("media-type")
+            if item_id is not None:
+                self.by_id.setdefault(item_id, item)
+            if href is not None:
+                self.by_href.setdefault(href, item)
+            if href is not None and media_type is not None:
+                name = os.path.normpath(os.path.join(base, href)).replace(os.sep, "/")
+                self.media_types[name] = media_type
+                self.by_media_type[media_type].append(name)
+                if item_id is not None:
+                    names.setdefault(item_id, name)
+            if (
+                item_id is not None
+                and item_id.translate(ASCII_LOWERCASE).startswith("cover")
+                and (media_type or "").startswith("image")
+            ):
+                self.cover_candidates.append(item)
+
+        for idref in opf.xpath(
+            "//opf:spine/opf:itemref/@idref", namespaces=OPF_NAMESPACES
+        ):
+            if idref in names:
+                self.spine.append(names[idref])
+
+        cover_meta = opf.xpath(
+            '//opf:metadata/opf:meta[@name="cover"]', namespaces=OPF_NAMESPACES
+        )
+        if cover_meta:
+            self.cover_id = cover_meta[0].get("content")
+
+    def names_of_types(self, media_types: Iterable[str]) -> List[str]:
+        """Get the names of the items with any of the media types, in order."""
+        media_types = frozenset(media_types)
+        return [
+            name
+            for name, media_type in self.media_types.items()
+            if media_type in media_types
+        ]
+
+
+class TransformCache:
+    """Converted content files, shared by containers across books.
+
+    Entries are keyed by the hash of a content file and of everything its
+    content passes depend on (see KEPubContainer.transform_key()), and hold
+    the converted data, or None if the passes didn't change the file, and the
+    file's next Kobo span paragraph number. Books from the same series or
+    publisher often share pages, and a book sent again after a small fix
+    shares most of its files with the previous version, so these are only
+    converted once. The least recently used entries are dropped once the
+    cached data is larger than limit bytes.
+    """
+
+    def __init__(self, version: Any, limit: int = TRANSFORM_CACHE_LIMIT) -> None:
+        """Create a cache for the converter at the given version."""
+        self.version = repr(version).encode("UTF-8")
+        self.limit = limit
+        self.stats = defaultdict(int)  # type: Dict[str, int]
+        self.__entries: "OrderedDict[str, Tuple[Optional[bytes], int]]" = OrderedDict()
+        self.__size = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Tuple[Optional[bytes], int]]:
+        """Get the converted data and paragraph number cached for key."""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry
+
+    def put(self, key: str, data: Optional[bytes], paragraph: int) -> None:
+        """Cache the converted data and paragraph number for key."""
+        size = len(data) if data is not None else 0
+        if size > self.limit:
+            return
+        with self.__lock:
+            old = self.__entries.pop(key, None)
+            if old is not None and old[0] is not None:
+                self.__size -= len(old[0])
+            self.__entries[key] = (data, paragraph)
+            self.__size += size
+            while self.__size > self.limit:
+                _key, (old_data, _paragraph) = self.__entries.popitem(last=False)
+                self.__size -= len(old_data) if old_data is not None else 0
+                self.stats["evictions"] += 1
+
+    def clear(self) -> None:
+        """Drop every cached content file."""
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+
+class ContainerMemberStore:
+    """The files of an ePub, held in memory instead of being extracted.
+
+    The archive is read once, from a path, bytes or a binary file object, but
+    the files in it are only listed from its central directory. The data of a
+    member is decompressed when it is read, and each time on_extract is called
+    with its name. Files written through the container replace the data of
+    their member.
+    """
+
+    def __init__(
+        self,
+        source: Union[str, bytes, BinaryIO],
+        on_extract: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        if isinstance(source, str):
+            with open(source, "rb") as f:
+                data = f.read()
+        elif isinstance(source, (bytes, bytearray, memoryview)):
+            data = bytes(source)
+        else:
+            data = source.read()
+
+        self.__on_extract = on_extract
+        self.__source = data
+        self.__archive = zipfile.ZipFile(BytesIO(data))
+        self.__infos = {}  # type: Dict[str, zipfile.ZipInfo]
+        # The data of each file in archive order, or None for members which
+        # haven't been written. Member names are normalized to NFC, as calibre
+        # does when extracting.
+        self.__data = {}  # type: Dict[str, Optional[bytes]]
+        for info in self.__archive.infolist():
+            if info.is_dir():
+                continue
+            name = unicodedata.normalize("NFC", info.filename)
+            self.__infos[name] = info
+            self.__data[name] = None
+
+    def names(self) -> List[str]:
+        """Get the names of all files, in archive order."""
+        return list(self.__data)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.__data
+
+    def read(self, name: str) -> bytes:
+        """Get the data of a file, decompressing it if it wasn't written."""
+        data = self.__data[name]
+        if data is None:
+            data = self.__archive.read(self.__infos[name])
+            if self.__on_extract is not None:
+                self.__on_extract(name)
+        return data
+
+    def write(self, name: str, data: bytes) -> None:
+        """Replace the data of a file, or add a new file."""
+        self.__data[name] = data
+
+    def remove(self, name: str) -> None:
+        """Forget a file."""
+        self.__data.pop(name, None)
+
+    def size(self, name: str) -> int:
+        """Get the uncompressed size of a file."""
+        data = self.__data[name]
+        if data is None:
+            return self.__infos[name].file_size
+        return len(data)
+
+    def open(self, name: str, mode: str = "rb") -> "ContainerMemberFile":
+        """Open a file as a binary file object."""
+        if "w" in mode:
+            data = b""
+        else:
+            data = self.read(name)
+        f = ContainerMemberFile(
+            self, name, data, writable="w" in mode or "+" in mode or "a" in mode
+        )
+        if "a" in mode:
+            f.seek(0, os.SEEK_END)
+        return f
+
+    def write_archive(
+        self,
+        out: Union[str, BinaryIO],
+        names: Iterable[str],
+        read: Callable[[str], bytes],
+        map_func: Callable[..., Iterator[Any]] = map,
+        level_for: Callable[[str], int] = lambda name: zlib.Z_DEFAULT_COMPRESSION,
+    ) -> Dict[str, int]:
+        """Write the named files to a new ePub archive.
+
+        The mimetype file is written first and uncompressed, as required by
+        the ePub specification, followed by every named file except those in
+        EXCLUDE_FROM_ZIP. Files keep the timestamps and attributes of their
+        original member.
+
+        Members which are unchanged are copied still compressed, and keep their
+        compression and CRC. Other files are read with read() and compressed at
+        the zlib level given by level_for(), or stored if the level is 0, by
+        map_func. map_func is called like map() and must yield results in
+        order, such as ContentWorkerPool.imap() to compress files in parallel.
+        Each file is written as soon as it and every file before it are ready.
+
+        @return: Counters of the members copied, compressed and stored, and of
+        the bytes read and written for compressed and stored files.
+        """
+        names = [
+            name for name in names if os.path.basename(name) not in EXCLUDE_FROM_ZIP
+        ]
+        counters = defaultdict(int)  # type: Dict[str, int]
+        with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(
+                zipfile.ZipInfo("mimetype", date_time=time.localtime()[:6]),
+                EPUB_MIMETYPE,
+                compress_type=zipfile.ZIP_STORED,
+            )
+            if _can_write_raw_members(archive):
+                self.__write_raw_members(
+                    archive, names, read, map_func, level_for, counters
+                )
+            else:
+                self.__write_members(archive, names, read, level_for, counters)
+        return counters
+
+    def __write_raw_members(
+        self,
+        archive: zipfile.ZipFile,
+        names: List[str],
+        read: Callable[[str], bytes],
+        map_func: Callable[..., Iterator[Any]],
+        level_for: Callable[[str], int],
+        counters: Dict[str, int],
+    ) -> None:
+        """Copy unchanged members and write files compressed by map_func."""
+        changed = [name for name in names if not self.__is_unchanged(name)]
+        compressed: Iterator[Tuple[int, int, int, bytes]] = map_func(
+            _compress_data,
+            [read] * len(changed),
+            changed,
+            [level_for(name) for name in changed],
+        )
+
+        changed_names = set(changed)
+        for name in names:
+            info = self.__member_info(name)
+            if name not in changed_names:
+                original = self.__infos[name]
+                info.compress_type = original.compress_type
+                # Sizes and CRC go in the local header, not a data descriptor
+                info.flag_bits = original.flag_bits & ~ZIP_DATA_DESCRIPTOR_FLAG
+                info.CRC = original.CRC
+                info.compress_size = original.compress_size
+                info.file_size = original.file_size
+                _write_raw_member(archive, info, self.__raw_member_data(name))
+                counters["copied"] += 1
+                continue
+            info.file_size, info.CRC, info.compress_type, data = next(compressed)
+            info.compress_size = len(data)
+            _write_raw_member(archive, info, data)
+            _count_written_member(counters, info)
+
+    def __write_members(
+        self,
+        archive: zipfile.ZipFile,
+        names: List[str],
+        read: Callable[[str], bytes],
+        level_for: Callable[[str], int],
+        counters: Dict[str, int],
+    ) -> None:
+        """Compress and write every file with zipfile, one at a time."""
+        for name in names:
+            info = self.__member_info(name)
+            level = level_for(name)
+            if level == 0:
+                info.compress_type = zipfile.ZIP_STORED
+            else:
+                info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, read(name), compresslevel=level)
+            _count_written_member(counters, info)
+
+    def __is_unchanged(self, name: str) -> bool:
+        """Determine if a file still has the data of its archive member.
+
+        Files written back with their original data, such as fonts which are
+        obfuscated again on commit, are unchanged too. The size and CRC of
+        their data only rule out changes; the data itself is compared.
+        """
+        if name not in self.__data or name not in self.__infos:
+            return False
+        data = self.__data[name]
+        if data is None:
+            return True
+        info = self.__infos[name]
+        if len(data) != info.file_size or zlib.crc32(data) != info.CRC:
+            return False
+        raw = self.__raw_member_data(name)
+        if info.compress_type == zipfile.ZIP_STORED:
+            return data == raw
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            return data == zlib.decompress(raw, -zlib.MAX_WBITS)
+        return data == self.__archive.read(info)
+
+    def __raw_member_data(self, name: str) -> memoryview:
+        """Get the compressed data of an archive member."""
+        original = self.__infos[name]
+        source = memoryview(self.__source)
+        start = original.header_offset
+        end = start + 30
+        header = source[start:end]
+        if header[:4] != ZIP_LOCAL_HEADER_SIGNATURE:
+            raise zipfile.BadZipFile(_(f"Bad local file header for {name}"))
+        name_length, extra_length = struct.unpack("<HH", header[26:])
+        start = end + name_length + extra_length
+        end = start + original.compress_size
+        return source[start:end]
+
+    def __member_info(self, name: str) -> zipfile.ZipInfo:
+        original = self.__infos.get(name)
+        if original is None:
+            return zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info = zipfile.ZipInfo(name, date_time=original.date_time)
+        info.external_attr = original.external_attr
+        return info
+
+
+class ContainerMemberFile(BytesIO):
+    """A file of a ContainerMemberStore opened as a binary file object.
+
+    Data written to the file is stored once it is closed.
+    """
+
+    def __init__(
+        self, store: ContainerMemberStore, name: str, data: bytes, writable: bool
+    ) -> None:
+        super(ContainerMemberFile, self).__init__(data)
+        self.__store = store
+        self.__name = name
+        self.__writable = writable
+
+    def writable(self) -> bool:
+        return self.__writable and super(ContainerMemberFile, self).writable()
+
+    def write(self, data) -> int:
+        if not self.__writable:
+            raise OSError(_(f"{self.__name} is not open for writing"))
+        return super(ContainerMemberFile, self).write(data)
+
+    def close(self) -> None:
+        if self.__writable and not self.closed:
+            self.__store.write(self.__name, self.getvalue())
+        super(ContainerMemberFile, self).close()
+
+
+def _compress_data(
+    read: Callable[[str], bytes], name: str, level: int
+) -> Tuple[int, int, int, bytes]:
+    """Read a file and compress it for a zip archive at a zlib level.
+
+    Files are stored uncompressed if the level is 0.
+
+    @return: The size and CRC of the file, its zip compression type, and its
+    data as written to the archive.
+    """
+    data = read(name)
+    if level == 0:
+        return len(data), zlib.crc32(data), zipfile.ZIP_STORED, data
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return (
+        len(data),
+        zlib.crc32(data),
+        zipfile.ZIP_DEFLATED,
+        compressor.compress(data) + compressor.flush(),
+    )
+
+
+def _count_written_member(counters: Dict[str, int], info: zipfile.ZipInfo) -> None:
+    """Count a file compressed or stored in an archive, and its sizes."""
+    if info.compress_type == zipfile.ZIP_STORED:
+        counters["stored"] += 1
+    else:
+        counters["compressed"] += 1
+    counters["compress_input_bytes"] += info.file_size
+    counters["compress_output_bytes"] += info.compress_size
+
+
+def _can_write_raw_members(archive: zipfile.ZipFile) -> bool:
+    """Determine if _write_raw_member works with this Python's zipfile.
+
+    It relies on zipfile internals, which are only known to be the same in the
+    Python versions of RAW_MEMBER_PYTHON_VERSIONS. Archives are written with
+    the public zipfile API in other versions, recompressing every file.
+    """
+    oldest, newest = RAW_MEMBER_PYTHON_VERSIONS
+    return oldest <= sys.version_info[:2] <= newest and all(
+        hasattr(archive, attribute)
+        for attribute in ("_writecheck", "_didModify", "fp", "start_dir")
+    )
+
+
+def _write_raw_member(archive: zipfile.ZipFile, info: zipfile.ZipInfo, data) -> None:
+    """Write already compressed data as a member of a zip archive.
+
+    zipfile can only write data it compresses itself, so the local header and
+    data are written to the archive file directly, and the member is then
+    registered with the archive for its central directory. The compression
+    type, sizes and CRC must be set on info. Check _can_write_raw_members()
+    first.
+    """
+    archive._writecheck(info)
+    archive._didModify = True
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+
+
 class KEPubContainer(EpubContainer):
     """Extends an EpubContainer to work for a KePub."""
 
     def __init__(
-        self, epub_path: str, log, do_cleanup: bool = False, *args, **kwargs
+        self,
+        epub_path: Union[str, bytes, BinaryIO],
+        log,
+        do_cleanup: bool = False,
+        *args,
+        fused: bool = False,
+        executor: str = EXECUTOR_THREAD,
+        parsed_cache_limit: int = PARSED_CACHE_LIMIT,
+        streaming_threshold: int = STREAMING_THRESHOLD,
+        backend: str = BACKEND_DISK,
+        compression: str = COMPRESSION_DEFAULT,
+        transform_cache: Optional[TransformCache] = None,
+        **kwargs,
     ) -> None:
-        self.paragraph_counter = defaultdict(lambda: 1)  # type: Dict[str, int]
-        super(KEPubContainer, self).__init__(epub_path, log, *args, **kwargs)
+        """Create a KePub container for the ePub at epub_path.
+
+        The backend selects where the files of the ePub are kept, and must be
+        one of BACKENDS. The memory backend reads the ePub once, keeps its
+        files in memory instead of extracting them to a temporary directory,
+        and writes the output archive directly on commit. Files are only
+        decompressed when they are read; the "extractions" stat counts these
+        reads. The memory backend is always used when epub_path is the ePub
+        data as bytes or a binary file object, and never for an extracted ePub
+        directory.
+
+        The compression policy, one of COMPRESSION_POLICIES, sets how files
+        changed or added with the memory backend are compressed on commit.
+        Unchanged files are always copied as they are.
+
+        Content passes use the results in transform_cache, if given, for
+        content files which were converted before in the same way, and add
+        their results for other files. The "transform_hits" and
+        "transform_misses" stats count both.
+
+        If fused is True, the cleanup passes are queued instead of being run
+        immediately, and run together with every other queued content pass
+        by run_content_passes() so each content file is only decoded, parsed,
+        and serialized once.
+
+        The executor selects how work is spread over content files, and must
+        be one of EXECUTORS.
+
+        Parsed content files which have been written are kept cached until
+        their estimated memory use exceeds parsed_cache_limit bytes, after
+        which the least recently used trees are dropped and re-parsed if
+        needed again. The "evictions" and "reparses" stats count both.
+
+        Content passes over content files larger than streaming_threshold
+        bytes parse and write the file incrementally, so the whole tree is
+        never in memory at once; the "streamed" stat counts these files. The
+        result is the same as when parsing in memory, which files calibre
+        would parse as HTML are still left to.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(_(f"Unknown backend {backend}"))
+        if compression not in COMPRESSION_POLICIES:
+            raise ValueError(_(f"Unknown compression policy {compression}"))
+        if not isinstance(epub_path, str):
+            backend = BACKEND_MEMORY
+        elif os.path.isdir(epub_path):
+            # Only archives can be read into memory
+            backend = BACKEND_DISK
+        self._init_content_state(log, executor)
+        self.parsed_cache_limit = parsed_cache_limit
+        self.streaming_threshold = streaming_threshold
+        self.compression = compression
+        self.transform_cache = transform_cache
+        if backend == BACKEND_MEMORY:
+            self.__init_in_memory(epub_path, log, *args, **kwargs)
+        else:
+            super(KEPubContainer, self).__init__(epub_path, log, *args, **kwargs)
         self.log = log
-        self.log.debug(f"Creating KePub Container for ePub at {epub_path}")
+        self.log.debug(
+            f"Creating KePub Container for ePub at {self.pathtoepub or '<memory>'} "
+            + f"with the {backend} backend"
+        )
+
+        language = self.opf_xpath("//opf:metadata/dc:language/text()")
+        self.set_language(language[0] if language else None)
 
-        self.__run_async_over_content(self.forced_cleanup)
+        self.queue_content_pass("forced_cleanup")
         if do_cleanup:
-            self.__run_async_over_content(self.clean_markup)
+            self.queue_content_pass("clean_markup")
+        if not fused:
+            self.run_content_passes()
+
+    def _init_content_state(self, log, executor: str) -> None:
+        if executor not in EXECUTORS:
+            raise ValueError(_(f"Unknown executor {executor}"))
+        if executor == EXECUTOR_PROCESS and not _can_fork_workers():
+            # Worker processes must inherit the loaded plugin modules, and
+            # forking is only safe enough on Linux
+            log.warning(
+                "Process executor is not supported on this platform, "
+                + "using threads instead"
+            )
+            executor = EXECUTOR_THREAD
+        self.executor = executor
+        self.set_language(None)
+        # Conversion state and locks by content file name. Calibre's container
+        # isn't thread-safe: the parse cache is only used with the lock of the
+        # file held, and state which calibre keeps for the container as a whole
+        # is kept per thread instead.
+        self.__contexts = {}  # type: Dict[str, ContentFileContext]
+        self.__file_locks = {}  # type: Dict[str, threading.RLock]
+        self.__contexts_lock = threading.Lock()
+        self.__thread_state = threading.local()
+        # The estimated memory use of cached content file trees, least recently
+        # used first, the files whose cached trees were written and not handed
+        # out since, which are the only ones which can be dropped, and the files
+        # whose trees were dropped from the cache.
+        self.parsed_cache_limit = PARSED_CACHE_LIMIT
+        self.__parsed_sizes = OrderedDict()  # type: OrderedDict[str, int]
+        self.__parsed_bytes = 0
+        self.__committed = set()  # type: Set[str]
+        self.__evicted = set()  # type: Set[str]
+        self.__lru_lock = threading.Lock()
+        self.streaming_threshold = STREAMING_THRESHOLD
+        self.__content_passes = []  # type: List[Tuple[str, Tuple[str, ...]]]
+        # Counters describing the work done on this book, such as the number of
+        # serialized files.
+        self.stats = defaultdict(int)  # type: Dict[str, int]
+        self.__stats_lock = threading.Lock()
+        # The files of the ePub when using the memory backend
+        self.__store = None  # type: Optional[ContainerMemberStore]
+        self.compression = COMPRESSION_DEFAULT
+        self.transform_cache = None  # type: Optional[TransformCache]
+        self.__manifest_index = None  # type: Optional[ManifestIndex]
+
+    def __init_in_memory(
+        self,
+        epub: Union[str, bytes, BinaryIO],
+        log,
+        clone_data: Optional[Dict[str, Any]] = None,
+        tdir: Optional[str] = None,
+    ) -> None:
+        """Set up the container over an ePub read into memory.
+
+        The root directory starts out empty. It only holds files that calibre
+        needs a path for, or that were written to directly, and these are used
+        instead of the in-memory data of their file.
+        """
+        if clone_data is not None:
+            raise ValueError(_("Containers using the memory backend can't be cloned"))
+        self.__store = ContainerMemberStore(
+            epub, on_extract=lambda name: self.count_stat("extractions")
+        )
+        self.pathtoepub = epub if isinstance(epub, str) else None
+        self.is_dir = False
+        if tdir is None:
+            tdir = PersistentTemporaryDirectory("_kepub_container")
+        root = os.path.abspath(os.path.realpath(tdir))
+
+        container = self.parse_xml(self.__store.read("META-INF/container.xml"))
+        opf_files = container.xpath('//*[local-name()="rootfile" and @full-path]')
+        if not opf_files:
+            raise InvalidEpub(_("No OPF file found in META-INF/container.xml"))
+        opf_name = unquote(opf_files[0].get("full-path")).lstrip("/")
+        if opf_name not in self.__store:
+            raise InvalidEpub(_(f"Could not locate OPF file {opf_name}"))
+
+        # Calibre sets up clones from existing name and MIME type maps, without
+        # walking the root directory, which is what an in-memory container needs
+        name_path_map = {}
+        mime_map = {}
+        for name in self.__store.names():
+            name_path_map[name] = os.path.join(root, *name.split("/"))
+            mime_map[name] = guess_type(name)[0] or "application/octet-stream"
+        mime_map[opf_name] = guess_type("a.opf")[0]
+        super(EpubContainer, self).__init__(
+            root,
+            name_path_map[opf_name],
+            log,
+            clone_data={
+                "root": root,
+                "name_path_map": name_path_map,
+                "opf_name": opf_name,
+                "mime_map": mime_map,
+                "pretty_print": set(),
+                "encoding_map": {},
+                "tweak_mode": False,
+            },
+        )
+        self.cloned = False
+        self.refresh_mime_map()
+
+        self.obfuscated_fonts = {}
+        if "META-INF/encryption.xml" in self.name_path_map:
+            self.process_encryption()
+        self.parsed_cache["META-INF/container.xml"] = container
+
+    def __in_store(self, name: str) -> bool:
+        """Determine if a file is read from and written to memory."""
+        return self.__store is not None and name in self.__store
+
+    def __read_member(self, name: str) -> bytes:
+        if self.__in_store(name):
+            return self.__store.read(name)
+        with open(self.name_path_map[name], "rb") as f:
+            return f.read()
+
+    def content_context(self, name: str) -> "ContentFileContext":
+        """Get the conversion state of a content file."""
+        with self.__contexts_lock:
+            context = self.__contexts.get(name)
+            if context is None:
+                context = self.__contexts[name] = ContentFileContext(name)
+        return context
+
+    @property
+    def paragraph_counter(self) -> Dict[str, int]:
+        """Get a copy of the next Kobo span paragraph number of each file."""
+        with self.__contexts_lock:
+            counter = {name: c.paragraph for name, c in self.__contexts.items()}
+        return defaultdict(lambda: 1, counter)
+
+    @paragraph_counter.setter
+    def paragraph_counter(self, counter: Dict[str, int]) -> None:
+        """Reset the conversion state, then set the given paragraph numbers."""
+        with self.__contexts_lock:
+            self.__contexts = {}
+        for name, paragraph in counter.items():
+            self.content_context(name).paragraph = paragraph
+
+    @property
+    def used_encoding(self) -> Optional[str]:
+        """Get the encoding found by the last decode() in this thread."""
+        return getattr(self.__thread_state, "used_encoding", None)
+
+    @used_encoding.setter
+    def used_encoding(self, encoding: Optional[str]) -> None:
+        self.__thread_state.used_encoding = encoding
+
+    def __file_lock(self, name: str) -> threading.RLock:
+        with self.__contexts_lock:
+            lock = self.__file_locks.get(name)
+            if lock is None:
+                lock = self.__file_locks[name] = threading.RLock()
+        return lock
+
+    def parsed(self, name: str):
+        """Get the parsed tree of a file, thread-safely."""
+        with self.__file_lock(name):
+            check_task_cancelled()
+            # The caller may change the tree before marking it dirty
+            self.__committed.discard(name)
+            reparse = name in self.__evicted and name not in self.parsed_cache
+            tree = super(KEPubContainer, self).parsed(name)
+            if reparse:
+                self.__evicted.discard(name)
+                self.count_stat("reparses")
+            self.__track_parsed(name)
+        self.__evict_parsed()
+        return tree
+
+    def replace(self, name: str, obj) -> None:
+        """Replace the parsed tree of a file, thread-safely."""
+        with self.__file_lock(name):
+            check_task_cancelled()
+            self.__committed.discard(name)
+            super(KEPubContainer, self).replace(name, obj)
+            self.__track_parsed(name)
+        self.__evict_parsed()
+
+    def commit_item(self, name: str, keep_parsed: bool = False) -> None:
+        """Serialize a changed file to disk, thread-safely."""
+        with self.__file_lock(name):
+            check_task_cancelled()
+            if self.__in_store(name) and name in self.parsed_cache:
+                data = self.serialize_item(name)
+                self.dirtied.discard(name)
+                if not keep_parsed:
+                    self.parsed_cache.pop(name)
+                self.__store.write(name, data)
+            else:
+                super(KEPubContainer, self).commit_item(name, keep_parsed=keep_parsed)
+            if name in self.parsed_cache and name not in self.dirtied:
+                self.__committed.add(name)
+            self.__track_parsed(name)
+        # A tree becomes evictable once written
+        self.__evict_parsed()
+
+    def open(self, name: str, mode: str = "rb"):
+        """Open a file, thread-safely committing any pending changes first."""
+        with self.__file_lock(name):
+            if "r" not in mode:
+                check_task_cancelled()
+            if self.__store is not None and (
+                name in self.__store
+                or ("r" not in mode and not os.path.exists(self.name_to_abspath(name)))
+            ):
+                if name in self.dirtied:
+                    self.commit_item(name)
+                self.parsed_cache.pop(name, None)
+                f = self.__store.open(name, mode)
+            else:
+                f = super(KEPubContainer, self).open(name, mode)
+            self.__track_parsed(name)
+            return f
+
+    def parse(self, path: str, mime: str):
+        """Parse a file, reading it from memory when using the memory backend."""
+        name = self.abspath_to_name(path)
+        if not self.__in_store(name):
+            return super(KEPubContainer, self).parse(path, mime)
+        data = self.__store.read(name)
+        if mime in OEB_DOCS:
+            data = self.parse_xhtml(data, name)
+        elif mime[-4:] in {"+xml", "/xml"}:
+            data = self.parse_xml(data)
+        elif mime in OEB_STYLES:
+            data = self.parse_css(data, name)
+        return data
+
+    def exists(self, name: str) -> bool:
+        """Determine if a file exists in this container."""
+        return self.__in_store(name) or super(KEPubContainer, self).exists(name)
+
+    def has_name_and_is_not_empty(self, name: str) -> bool:
+        """Determine if a file is in this container and has data."""
+        if self.__in_store(name) and name in self.name_path_map:
+            return self.__store.size(name) > 0
+        return super(KEPubContainer, self).has_name_and_is_not_empty(name)
+
+    def filesize(self, name: str) -> int:
+        """Get the size of a file, committing any pending changes first."""
+        if not self.__in_store(name):
+            return super(KEPubContainer, self).filesize(name)
+        if name in self.dirtied:
+            self.commit_item(name, keep_parsed=True)
+        return self.__store.size(name)
+
+    def get_file_path_for_processing(
+        self, name: str, allow_modification: bool = True
+    ) -> str:
+        """Get the path of a file for code which works on files directly.
+
+        With the memory backend the file is written out to the root directory,
+        and the file on disk is used from then on.
+        """
+        path = super(KEPubContainer, self).get_file_path_for_processing(
+            name, allow_modification=allow_modification
+        )
+        if self.__in_store(name):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(self.__store.read(name))
+            self.__store.remove(name)
+        return path
+
+    def remove_item(self, name: str, remove_from_guide: bool = True) -> None:
+        """Remove a file from this container and the OPF manifest."""
+        super(KEPubContainer, self).remove_item(
+            name, remove_from_guide=remove_from_guide
+        )
+        if self.__store is not None:
+            self.__store.remove(name)
+
+    def commit(self, outpath: Optional[str] = None, keep_parsed: bool = False):
+        """Write every changed file, then the ePub to outpath.
+
+        With the memory backend the archive is written directly from memory,
+        and outpath may also be a binary file object. How long writing the
+        archive took and how much compression saved is logged, and the
+        "copied", "compressed" and "stored" stats count the files written.
+        """
+        if self.__store is None:
+            return super(KEPubContainer, self).commit(
+                outpath=outpath, keep_parsed=keep_parsed
+            )
+
+        super(EpubContainer, self).commit(keep_parsed=keep_parsed)
+        # Fonts are kept deobfuscated while the container is used
+        restore_fonts = {}
+        for name, (alg, key) in self.obfuscated_fonts.items():
+            if name not in self.name_path_map:
+                continue
+            restore_fonts[name] = data = self.raw_data(name, decode=False)
+            with self.open(name, "wb") as f:
+                f.write(decrypt_font_data(key, data, alg))
+
+        outpath = outpath or self.pathtoepub
+        if outpath is None:
+            raise ValueError(_("An output path must be given"))
+        policy = COMPRESSION_POLICIES[self.compression]
+        try:
+            start = time.monotonic()
+            counters = self.__store.write_archive(
+                outpath,
+                list(self.name_path_map),
+                self.__read_member,
+                map if self.executor == EXECUTOR_SERIAL else worker_pool.imap,
+                lambda name: policy[classify_media_type(self.mime_map.get(name))],
+            )
+            elapsed = time.monotonic() - start
+        finally:
+            for name, data in restore_fonts.items():
+                with self.open(name, "wb") as f:
+                    f.write(data)
+
+        for stat, count in counters.items():
+            self.count_stat(stat, count)
+        self.log.info(
+            f"Wrote the ePub in {elapsed:.3f} seconds with the {self.compression} "
+            + f"compression policy: {counters['compressed']} files compressed "
+            + f"and {counters['stored']} stored from "
+            + f"{counters['compress_input_bytes']} to "
+            + f"{counters['compress_output_bytes']} bytes, "
+            + f"{counters['copied']} unchanged files copied"
+        )
+
+    def __track_parsed(self, name: str) -> None:
+        """Update the cache accounting for a content file tree.
+
+        Must be called with the file lock held, after the tree was used,
+        replaced or removed from the parse cache.
+        """
+        if self.mime_map.get(name) not in HTML_MIMETYPES:
+            return
+        with self.__lru_lock:
+            self.__parsed_bytes -= self.__parsed_sizes.pop(name, 0)
+            if name in self.parsed_cache:
+                size = self.__content_size(name) * PARSED_TREE_SIZE_FACTOR
+                self.__parsed_sizes[name] = size
+                self.__parsed_bytes += size
+
+    def __evict_parsed(self) -> None:
+        """Drop the least recently used written trees while over the limit."""
+        with self.__lru_lock:
+            if self.__parsed_bytes <= self.parsed_cache_limit:
+                return
+            # Never drop the most recently used tree
+            for name in list(self.__parsed_sizes)[:-1]:
+                if self.__parsed_bytes <= self.parsed_cache_limit:
+                    break
+                if name not in self.__committed:
+                    continue
+                # Skip files being worked on instead of waiting for them
+                lock = self.__file_lock(name)
+                if not lock.acquire(blocking=False):
+                    continue
+                try:
+                    if name not in self.__committed:
+                        continue
+                    self.__committed.discard(name)
+                    self.parsed_cache.pop(name, None)
+                    self.__parsed_bytes -= self.__parsed_sizes.pop(name)
+                    self.__evicted.add(name)
+                finally:
+                    lock.release()
+                self.count_stat("evictions")
+
+    def set_language(self, language: Optional[str]) -> None:
+        """Set the book language, selecting the sentence segmenter for spans."""
+        self.language = language
+        self.segmenter = segmenter_for_language(language)
 
     def html_names(self) -> Iterator[str]:
         """Get all HTML files in the OPF file.
 
         A generator function that yields only HTML file names from the ePub.
         """
-        for node in self.opf_xpath("//opf:manifest/opf:item[@href and @media-type]"):
-            if node.get("media-type") in HTML_MIMETYPES:
-                href = os.path.join(os.path.dirname(self.opf_name), node.get("href"))
-                href = os.path.normpath(href).replace(os.sep, "/")
-                yield href
+        yield from self.manifest_index().names_of_types(HTML_MIMETYPES)
+
+    def manifest_index(self) -> ManifestIndex:
+        """Get the index of the OPF manifest, rebuilding it if the OPF changed."""
+        opf = self.opf
+        index = self.__manifest_index
+        if index is None or index.opf is not opf:
+            index = self.__manifest_index = ManifestIndex(opf, self.opf_name)
+        return index
+
+    def dirty(self, name: str) -> None:
+        """Mark a file as changed, dropping the manifest index for the OPF."""
+        check_task_cancelled()
+        if name == self.opf_name:
+            self.__manifest_index = None
+        super(KEPubContainer, self).dirty(name)
 
     @property
     def is_drm_encumbered(self) -> bool:
@@ -165,14 +1490,32 @@ class KEPubContainer(EpubContainer):
 
         return is_encumbered
 
-    def flush_cache(self) -> None:
-        args = [(name,) for name in self.dirtied]
-        self.__run_async(self.__flush_cache_impl, args)
+    def flush_cache(self, names: Optional[Iterable[str]] = None) -> None:
+        """Flush the cache, writing cached values to disk.
+
+        Only dirtied files are written. If names is given, only those files are
+        written, otherwise every dirtied file is. Parsed values are kept in the
+        cache.
+        """
+        if names is None:
+            dirtied = tuple(self.dirtied)
+        else:
+            dirtied = tuple(name for name in names if name in self.dirtied)
+        self.__run_async(self.__flush_cache_impl, [(name,) for name in dirtied])
 
     def __flush_cache_impl(self, name: str) -> None:
-        """Flush the cache, writing all cached values to disk."""
         self.commit_item(name, keep_parsed=True)
 
+    def serialize_item(self, name: str):
+        """Serialize a cached item, counting each serialization in self.stats."""
+        self.count_stat("serializations")
+        return super(KEPubContainer, self).serialize_item(name)
+
+    def count_stat(self, stat: str, count: int = 1) -> None:
+        """Thread-safely add count to the named counter in self.stats."""
+        with self.__stats_lock:
+            self.stats[stat] += count
+
     def copy_file_to_container(
         self, path: str, name: Optional[str] = None, mt: Optional[str] = None
     ) -> str:
@@ -192,9 +1535,13 @@ class KEPubContainer(EpubContainer):
             basename: str = os.path.basename(path)
         else:
             basename: str = name
-        item = self.generate_item(basename, media_type=mt)
-        # Unnecessary casse but pyright things href_to_name could return many things
-        basename = str(self.href_to_name(item.get("href"), self.opf_name))
+        basename = self.__generate_file_item(basename, mt)
+
+        if self.__store is not None:
+            self.log.info(f"Copying file '{path}' into memory as '{basename}'")
+            with open(path, "rb") as f:
+                self.__store.write(basename, f.read())
+            return basename
 
         self.log.info(f"Copying file '{path}' to '{self.root}' as '{basename}'")
 
@@ -208,6 +1555,41 @@ class KEPubContainer(EpubContainer):
 
         return basename
 
+    def copy_data_to_container(
+        self, data: bytes, name: str, mt: Optional[str] = None
+    ) -> str:
+        """Add a file with the given data to this Container instance.
+
+        This works like copy_file_to_container() for data which isn't in a
+        file, without writing it to a temporary file first.
+
+        @return: The name of the file relative to the Container root
+        """
+        name = self.__generate_file_item(name, mt)
+        if self.__store is not None:
+            self.log.info(f"Adding '{name}' in memory")
+            self.__store.write(name, data)
+            return name
+
+        self.log.info(f"Adding '{name}' to '{self.root}'")
+        path = self.name_to_abspath(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+        return name
+
+    def __generate_file_item(self, name: str, mt: Optional[str]) -> str:
+        """Add a new file to the manifest, returning its name."""
+        item = self.generate_item(name, media_type=mt)
+        # Unnecessary casse but pyright things href_to_name could return many things
+        name = str(self.href_to_name(item.get("href"), self.opf_name))
+        if self.__store is not None:
+            # Calibre creates an empty file on disk for every generated item
+            placeholder = self.name_to_abspath(name)
+            if os.path.isfile(placeholder) and not os.path.getsize(placeholder):
+                os.remove(placeholder)
+        return name
+
     def add_content_file_reference(self, name: str) -> None:
         """Add a reference to the named file to all content files.
 
@@ -216,50 +1598,57 @@ class KEPubContainer(EpubContainer):
         MIME type of text/css and JavaScript files with a MIME type of
         application/x-javascript are supported.
         """
+        self.add_content_file_references([name])
+
+    def add_content_file_references(self, names: List[str]) -> None:
+        """Add references to all the named files to all content files.
+
+        This works like add_content_file_reference() for each name in turn,
+        but adds every reference, in order, in a single pass over the content
+        files. The "add_content_file_reference" content pass also takes any
+        number of names.
+        """
+        for name in names:
+            self.__check_content_file_reference(name)
+        self.__run_stage(self.__add_content_file_reference_impl, tuple(names))
+
+    def __check_content_file_reference(self, name: str) -> None:
         if name not in self.name_path_map or name not in self.mime_map:
             raise ValueError(_(f"A valid file name must be given (got {name})"))
 
-        self.__run_async_over_content(self.__add_content_file_reference_impl, (name,))
-
-    def __add_content_file_reference_impl(self, infile: str, name: str) -> None:
-        self.log.debug(f"Adding reference to {name} to file {infile}")
+    def __add_content_file_reference_impl(self, infile: str, *names: str) -> None:
         root = self.parsed(infile)
         if root is None:
             raise Exception(_(f"Could not retrieve content file {infile}"))
-        head = root.xpath("./xhtml:head", namespaces={"xhtml": XHTML_NAMESPACE})
-        if head is None:
-            raise Exception(_(f"Could not find a <head> element in {infile}"))
-        head = head[0]
-        if head is None:
-            raise Exception(
-                _(
-                    "A <head> section was found but was undefined in content "
-                    + f"file {infile}"
-                )
-            )
+        if self.__add_content_file_reference_to_root(root, infile, *names):
+            self.dirty(infile)
 
-        if self.mime_map[name] == CSS_MIMETYPE:
-            elem = head.makeelement(
-                f"{{{XHTML_NAMESPACE}}}link",
-                rel="stylesheet",
-                href=os.path.relpath(name, os.path.dirname(infile)).replace(
-                    os.sep, "/"
-                ),
-            )
-        elif self.mime_map[name] == JS_MIMETYPE:
-            elem = head.makeelement(
-                f"{{{XHTML_NAMESPACE}}}script",
-                type="text/javascript",
-                src=os.path.relpath(name, os.path.dirname(infile)).replace(os.sep, "/"),
-            )
-        else:
-            elem = None
+    def __add_content_file_reference_to_root(
+        self, root: etree._Element, infile: str, *names: str
+    ) -> bool:
+        self.log.debug(f"Adding reference to {', '.join(names)} to file {infile}")
+        self.__check_head(infile, self.__census(root, infile)["heads"])
+        head = root.find(f"{{{XHTML_NAMESPACE}}}head")
+
+        changed = False
+        for name in names:
+            href = os.path.relpath(name, os.path.dirname(infile)).replace(os.sep, "/")
+            if self.mime_map[name] == CSS_MIMETYPE:
+                elem = head.makeelement(
+                    f"{{{XHTML_NAMESPACE}}}link", rel="stylesheet", href=href
+                )
+            elif self.mime_map[name] == JS_MIMETYPE:
+                elem = head.makeelement(
+                    f"{{{XHTML_NAMESPACE}}}script", type="text/javascript", src=href
+                )
+            else:
+                continue
 
-        if elem is not None:
             head.append(elem)
             if self.mime_map[name] == CSS_MIMETYPE:
                 self.fix_tail(elem)
-            self.dirty(infile)
+            changed = True
+        return changed
 
     def fix_tail(self, item: etree._Element) -> None:
         """Fix self-closing elements.
@@ -285,11 +1674,18 @@ class KEPubContainer(EpubContainer):
 
     def forced_cleanup(self, name: str) -> None:
         """Perform cleanup considered essential for standards compliance."""
-        self.log.debug(f"Forcing cleanup for file {name}")
+        self.__text_pass_impl(name, self.__forced_cleanup_text)
+        self.flush_cache([name])
+
+    def __text_pass_impl(self, name: str, func: Callable[[str, str], str]) -> None:
         html = self.raw_data(name, decode=True, normalize_to_nfc=True)
         if html is None:
             raise Exception(_(f"No HTML content in {name}"))
 
+        self.replace(name, self.parse_xhtml(func(html, name)))
+
+    def __forced_cleanup_text(self, html: str, name: str) -> str:
+        self.log.debug(f"Forcing cleanup for file {name}")
         encoding_match = ENCODING_RE.search(str(html[:75]))
         if encoding_match and encoding_match.group(1).upper() != "UTF-8":
             html = re.sub(encoding_match.group(1), "UTF-8", html, 1, re.MULTILINE)
@@ -303,8 +1699,7 @@ class KEPubContainer(EpubContainer):
         # Remove Unicode replacement characters
         html = html.replace("\uFFFD", "")
 
-        self.replace(name, self.parse_xhtml(html))
-        self.flush_cache()
+        return html
 
     def clean_markup(self, name: str) -> None:
         """Clean HTML markup.
@@ -312,11 +1707,11 @@ class KEPubContainer(EpubContainer):
         This cleans the HTML markup for things which are not strictly
         non-compliant but can cause problems.
         """
-        self.log.debug(f"Cleaning markup for file {name}")
-        html = self.raw_data(name, decode=True, normalize_to_nfc=True)
-        if html is None:
-            raise Exception(_(f"No HTML content in {name}"))
+        self.__text_pass_impl(name, self.__clean_markup_text)
+        self.flush_cache([name])
 
+    def __clean_markup_text(self, html: str, name: str) -> str:
+        self.log.debug(f"Cleaning markup for file {name}")
         # Get rid of Microsoft cruft
         html = MS_CRUFT_RE_1.sub(" ", html)
         html = MS_CRUFT_RE_2.sub("", html)
@@ -324,20 +1719,16 @@ class KEPubContainer(EpubContainer):
         # Remove empty headings
         html = EMPTY_HEADINGS_RE.sub("", html)
 
-        self.replace(name, self.parse_xhtml(html))
-        self.flush_cache()
+        return html
 
     def smarten_punctuation(self) -> None:
-        self.__run_async_over_content(self.__smarten_punctuation_impl)
-
-    def __smarten_punctuation_impl(self, name: str) -> None:
         """Convert standard punctuation to "smart" punctuation."""
+        self.__run_stage(self.__text_pass_impl, (self.__smarten_punctuation_text,))
+
+    def __smarten_punctuation_text(self, html: str, name: str) -> str:
         preprocessor = HeuristicProcessor(log=self.log)
 
         self.log.debug(f"Smartening punctuation for file {name}")
-        html = self.raw_data(name, decode=True, normalize_to_nfc=True)
-        if html is None:
-            raise Exception(_(f"No HTML content in file {name}"))
 
         # Fix non-breaking space indents
         html = preprocessor.fix_nbsp_indents(html)
@@ -359,38 +1750,675 @@ class KEPubContainer(EpubContainer):
         html = html.replace("<! &#x2014; ", "<!-- ")
         html = html.replace(" &#x2014; >", " -->")
 
-        self.replace(name, self.parse_xhtml(html))
-        self.flush_cache()
+        return html
+
+    def queue_content_pass(self, name: str, *args: str) -> None:
+        """Queue a content pass to be run by run_content_passes().
+
+        Passes run in the order they are queued, except that all text passes
+        (see TEXT_PASSES) run before any tree pass (see TREE_PASSES) since the
+        tree passes work on the document parsed from the text passes' output.
+        """
+        if name not in TEXT_PASSES and name not in TREE_PASSES:
+            raise ValueError(_(f"Unknown content pass {name}"))
+        if name == "add_content_file_reference":
+            for ref in args:
+                self.__check_content_file_reference(ref)
+
+        self.__content_passes.append((name, args))
+
+    def run_content_passes(self) -> None:
+        """Run all queued content passes over every content file.
+
+        Each content file is decoded and normalized once, run through all
+        queued text passes, parsed once, run through all queued tree passes,
+        and written back once. Files are pipelined: the worker transforming a
+        file also writes it, and drops its tree, instead of waiting for every
+        other file to finish a pass first.
+        """
+        passes = self.__content_passes
+        self.__content_passes = []
+        if not passes:
+            return
+
+        self.log.debug(
+            "Running content passes: " + ", ".join(name for name, _args in passes)
+        )
+        if self.executor == EXECUTOR_PROCESS:
+            self.__run_content_passes_in_processes(passes)
+        else:
+            self.__run_async_over_content(self.__run_content_passes_impl, (passes,))
+
+    def __run_content_passes_in_processes(
+        self, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> None:
+        """Run content passes in worker processes.
+
+        Each worker gets the raw data of one content file along with the MIME
+        types it needs, and returns the transformed data and the file's
+        paragraph counter.
+        """
+        refs = set()
+        for name, args in passes:
+            if name == "add_content_file_reference":
+                refs.update(args)
+
+        names = []
+        keys = []
+        tasks = []
+        for name in self.__longest_first(list(self.html_names()), lambda name: name):
+            data = self.raw_data(name, decode=False)
+            key = None
+            if self.transform_cache is not None:
+                key = self.transform_key(name, data, passes)
+                if self.__use_cached_transform(name, key):
+                    continue
+            names.append(name)
+            keys.append(key)
+            mime_map = {
+                n: self.mime_map[n] for n in refs | {name} if n in self.mime_map
+            }
+            tasks.append(
+                (
+                    (
+                        name,
+                        data,
+                        mime_map,
+                        self.language,
+                        passes,
+                        self.streaming_threshold,
+                    ),
+                    self.__time_budget(name),
+                )
+            )
+        results = worker_pool.run(_run_content_passes_in_worker, tasks, processes=True)
+        for name, key, (data, paragraph_count) in zip(names, keys, results):
+            self.content_context(name).paragraph = paragraph_count
+            if key is not None:
+                self.transform_cache.put(key, data, paragraph_count)
+            if data is not None:
+                self.count_stat("serializations")
+                self.__replace_data(name, data)
+
+    def __replace_data(self, name: str, data: bytes) -> None:
+        """Replace the contents of a file with already serialized data."""
+        self.parsed_cache.pop(name, None)
+        self.dirtied.discard(name)
+        with self.open(name, "wb") as f:
+            f.write(data)
+
+    def __split_content_passes(
+        self, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> Tuple[
+        List[Tuple[Callable[..., str], Tuple[str, ...]]],
+        List[Tuple[Callable[..., bool], Tuple[str, ...]]],
+    ]:
+        text_passes = [
+            (self.__text_pass_func(name), args)
+            for name, args in passes
+            if name in TEXT_PASSES
+        ]
+        tree_passes = [
+            (self.__tree_pass_func(name), args)
+            for name, args in passes
+            if name in TREE_PASSES
+        ]
+        return text_passes, tree_passes
+
+    def __text_pass_func(self, name: str) -> Callable[..., str]:
+        return {
+            "forced_cleanup": self.__forced_cleanup_text,
+            "clean_markup": self.__clean_markup_text,
+            "smarten_punctuation": self.__smarten_punctuation_text,
+        }[name]
+
+    def __tree_pass_func(self, name: str) -> Callable[..., bool]:
+        return {
+            "add_content_file_reference": self.__add_content_file_reference_to_root,
+            "add_kobo_spans": self.__add_kobo_spans_to_root,
+            "add_kobo_divs": self.__add_kobo_divs_to_root,
+        }[name]
+
+    def transform_key(
+        self, name: str, data: bytes, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> str:
+        """Get the transform cache key of running content passes over a file.
+
+        Besides the file data and the passes, the result depends on the book
+        language, the file's MIME type, the paragraph number its Kobo spans
+        start at, and where referenced files are relative to it.
+        """
+        stages = []
+        for pass_name, args in passes:
+            if pass_name == "add_content_file_reference":
+                args = tuple(
+                    (
+                        os.path.relpath(ref, os.path.dirname(name)),
+                        self.mime_map.get(ref),
+                    )
+                    for ref in args
+                )
+            stages.append((pass_name, args))
+        digest = hashlib.sha256()
+        digest.update(self.transform_cache.version)
+        digest.update(
+            repr(
+                (
+                    self.language,
+                    self.mime_map.get(name),
+                    self.content_context(name).paragraph,
+                    stages,
+                )
+            ).encode("UTF-8")
+        )
+        digest.update(data)
+        return digest.hexdigest()
+
+    def __use_cached_transform(self, name: str, key: str) -> bool:
+        """Replace a content file with its cached conversion, if there is one."""
+        cached = self.transform_cache.get(key)
+        if cached is None:
+            self.count_stat("transform_misses")
+            return False
+        self.count_stat("transform_hits")
+        data, self.content_context(name).paragraph = cached
+        if data is not None:
+            with self.__file_lock(name):
+                self.__replace_data(name, data)
+        return True
+
+    def __run_cached_content_passes(
+        self, name: str, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> None:
+        data = self.raw_data(name, decode=False)
+        key = self.transform_key(name, data, passes)
+        if self.__use_cached_transform(name, key):
+            return
+
+        data = self._transform_content_data(name, data, passes)
+        self.transform_cache.put(key, data, self.content_context(name).paragraph)
+        if data is not None:
+            self.count_stat("serializations")
+            with self.__file_lock(name):
+                self.__replace_data(name, data)
 
-    def __run_async(self, func: Callable, args: List[Tuple[str, ...]]) -> None:
-        futures: List[Future] = []
-        with ThreadPoolExecutor() as pool:
-            futures = [pool.submit(func, *arg) for arg in args]
-        for future in futures:
-            future.result(timeout=10)
+    def __run_content_passes_impl(
+        self, name: str, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> None:
+        if self.transform_cache is not None:
+            self.__run_cached_content_passes(name, passes)
+            return
+
+        text_passes, tree_passes = self.__split_content_passes(passes)
+        stream = self.__content_size(name) > self.streaming_threshold
+        html = None  # type: Optional[str]
+        if text_passes or stream:
+            html = self.raw_data(name, decode=True, normalize_to_nfc=True)
+            if html is None:
+                raise Exception(_(f"No HTML content in {name}"))
+            for func, args in text_passes:
+                html = func(html, name, *args)
+        if stream:
+            streamed, data = self.__stream_content_data(
+                name, html, passes, bool(text_passes)
+            )
+            if streamed:
+                if data is not None:
+                    self.count_stat("serializations")
+                    with self.__file_lock(name):
+                        self.__replace_data(name, data)
+                return
+
+        if text_passes:
+            root = self.parse_xhtml(html)
+            changed = True
+        else:
+            root = self.parsed(name)
+            if root is None:
+                raise Exception(_(f"Could not retrieve content file {name}"))
+            changed = False
+
+        context = self.content_context(name)
+        context.root = root
+        try:
+            for func, args in tree_passes:
+                check_task_cancelled()
+                if func(context.root, name, *args):
+                    changed = True
+
+            if changed:
+                self.replace(name, context.root)
+                self.commit_item(name)
+        finally:
+            context.root = None
+            context.census = None
+
+    def _transform_content_data(
+        self, name: str, data: bytes, passes: List[Tuple[str, Tuple[str, ...]]]
+    ) -> Optional[bytes]:
+        """Run content passes over the raw data of a content file.
+
+        Returns the serialized result, or None if nothing changed. Apart from
+        the file's conversion context no container state is touched, which
+        allows this to run in a worker process.
+        """
+        text_passes, tree_passes = self.__split_content_passes(passes)
+        stream = len(data) > self.streaming_threshold
+        html = None  # type: Optional[str]
+        if text_passes or stream:
+            html = self.decode(data, normalize_to_nfc=True)
+            for func, args in text_passes:
+                html = func(html, name, *args)
+        if stream:
+            streamed, result = self.__stream_content_data(
+                name, html, passes, bool(text_passes)
+            )
+            if streamed:
+                return result
+
+        if text_passes:
+            root = self.parse_xhtml(html, name)
+            changed = True
+        else:
+            root = self.parse_xhtml(data, name)
+            changed = False
+
+        context = self.content_context(name)
+        context.root = root
+        try:
+            for func, args in tree_passes:
+                if func(context.root, name, *args):
+                    changed = True
+
+            if not changed:
+                return None
+            return serialize(context.root, self.mime_map.get(name, guess_type(name)[0]))
+        finally:
+            context.root = None
+            context.census = None
+
+    def __stream_content_data(
+        self,
+        name: str,
+        html: str,
+        passes: List[Tuple[str, Tuple[str, ...]]],
+        changed: bool,
+    ) -> Tuple[bool, Optional[bytes]]:
+        """Try to run content passes over a content file while streaming it.
+
+        html is the text of the file, decoded and normalized as calibre does
+        before parsing it, after any text passes; changed is whether these
+        changed it. Returns whether the file could be streamed, and if so the
+        serialized result or None if nothing changed. The result is the same
+        as when parsing the file in memory, which files that can't be streamed
+        (see _stream_fallback_reason()) are left to.
+        """
+        # The text is re-encoded, so any declared encoding no longer holds
+        data = XML_DECLARATION_RE.sub("", html, count=1).encode("utf-8")
+        reason = _stream_fallback_reason(data)
+        if reason is None:
+            context = self.content_context(name)
+            paragraph = context.paragraph
+            try:
+                result = self.__stream_content_passes(name, data, passes, changed)
+            except etree.XMLSyntaxError as e:
+                context.paragraph = paragraph
+                reason = str(e)
+        if reason is not None:
+            self.log.debug(f"Parsing {name} in memory, it can't be streamed: {reason}")
+            return False, None
+
+        self.count_stat("streamed")
+        return True, result
+
+    def __stream_content_passes(
+        self,
+        name: str,
+        data: bytes,
+        passes: List[Tuple[str, Tuple[str, ...]]],
+        changed: bool,
+    ) -> Optional[bytes]:
+        """Run content passes while parsing and writing a content file.
+
+        The file is parsed twice with iterparse: once to count the elements
+        checked before adding Kobo spans and divs, and once to write it out.
+        While writing, only the open elements and the last complete child of
+        each are kept in the tree. Children of the body the span walker
+        descends into are streamed as well, all others, and those the parser
+        has already read to the end, are converted as a whole once complete,
+        so the span IDs are the same as those added to a fully parsed tree.
+        Returns the serialized result, or None if nothing changed.
+        """
+        counts = _count_stream_elements(data)
+        references = [
+            ref
+            for pass_name, args in passes
+            if pass_name == "add_content_file_reference"
+            for ref in args
+        ]
+        spans = any(pass_name == "add_kobo_spans" for pass_name, _args in passes)
+        divs = any(pass_name == "add_kobo_divs" for pass_name, _args in passes)
+        if references:
+            self.__check_head(name, counts["heads"])
+        if spans:
+            self.log.debug(f"Adding Kobo spans to {name}")
+            self.__check_no_kobo_spans(name, counts["kobo_spans"])
+        if divs:
+            self.log.debug(f"Adding Kobo divs to {name}")
+            divs = self.__should_add_kobo_divs(
+                name, counts["kobo_divs"], counts["divs"], counts["ps"]
+            )
+
+        context = self.content_context(name)
+        writer = StreamWriter(self.mime_map.get(name, guess_type(name)[0]))
+        body_tag = f"{{{XHTML_NAMESPACE}}}body"
+        frames = []  # type: List[StreamFrame]
+        root_frame = None  # type: Optional[StreamFrame]
+        # The depth inside a child which is converted once complete
+        buffered = 0
+        for event, node in etree.iterparse(
+            BytesIO(data), events=("start", "end", "comment", "pi"), huge_tree=True
+        ):
+            if buffered:
+                if event == "start":
+                    buffered += 1
+                elif event == "end":
+                    buffered -= 1
+                continue
+
+            if event == "end":
+                frame = frames.pop()
+                self.__close_stream_frame(writer, frame, context)
+                if frames:
+                    frames[-1].pending = node
+                    frames[-1].pending_written = True
+                    frames[-1].pending_tail = frame.keep_tail
+                continue
+
+            if not frames:
+                if event == "start":
+                    root_frame = StreamFrame(node, False)
+                    root_frame.start_tags.append(writer.write_declaration(node))
+                    root_frame.references = references
+                    frames.append(root_frame)
+                # Comments and processing instructions outside of the root
+                # are dropped, as when serializing a parsed tree
+                continue
+
+            frame = frames[-1]
+            self.__next_stream_child(writer, frame, context)
+            if event != "start":
+                descend = False
+            elif len(frames) == 1:
+                descend = node.tag == body_tag and (spans or divs)
+            else:
+                # Elements the parser has already gone past, such as void
+                # elements and most paragraphs, are complete as they start
+                descend = (
+                    frame.spans
+                    and classify_tag(node.tag) == TAG_DESCEND
+                    and local_tag_name(node.tag) not in VOID_TAGS
+                    and node.tail is None
+                    and node.getnext() is None
+                )
+            if descend:
+                # The element holds a child, so it isn't empty
+                self.__open_stream_tags(writer, frame)
+                child = self.__open_stream_frame(
+                    writer, node, spans, divs and len(frames) == 1
+                )
+                # Adding Kobo spans or divs drops the whitespace after the
+                # body
+                child.keep_tail = len(frames) > 1
+                frames.append(child)
+            else:
+                frame.pending = node
+                frame.pending_written = False
+                frame.pending_tail = True
+                buffered = 1 if event == "start" else 0
+
+        referenced = root_frame is not None and root_frame.referenced
+        if not (changed or spans or divs or referenced):
+            return None
+        return writer.getvalue()
+
+    def __open_stream_frame(
+        self,
+        writer: "StreamWriter",
+        node: etree._Element,
+        spans: bool,
+        divs: bool = False,
+    ) -> "StreamFrame":
+        """Start streaming an element, wrapping its content in Kobo divs."""
+        frame = StreamFrame(node, spans)
+        frame.start_tags.append(writer.start_tag(node))
+        if divs:
+            for div_id in ("book-columns", "book-inner"):
+                div = etree.SubElement(
+                    node, f"{{{XHTML_NAMESPACE}}}div", attrib={"id": div_id}
+                )
+                frame.empty_div = writer.serialize(div)
+                frame.start_tags.append(_start_tag(frame.empty_div))
+                node.remove(div)
+        return frame
+
+    def __open_stream_tags(self, writer: "StreamWriter", frame: "StreamFrame") -> None:
+        """Write the start tags of a streamed element, unless already written."""
+        if not frame.opened:
+            frame.opened = True
+            for start_tag in frame.start_tags:
+                writer.write(start_tag + b">")
+
+    def __next_stream_child(
+        self,
+        writer: "StreamWriter",
+        frame: "StreamFrame",
+        context: "ContentFileContext",
+    ) -> None:
+        """Write everything in a streamed element before its next child.
+
+        It is collected in a holder element and serialized at once. The holder
+        is removed before parsing goes on, or the text parsed after it would
+        become its tail.
+        """
+        holder = etree.SubElement(frame.node, f"{{{XHTML_NAMESPACE}}}span")
+        try:
+            if not frame.started:
+                frame.started = True
+                self.__write_stream_text(frame, holder, frame.node.text, context)
+                frame.node.text = None
+            else:
+                self.__write_stream_child(frame, holder, context)
+            if len(holder) or holder.text:
+                self.__open_stream_tags(writer, frame)
+                writer.write(writer.serialize_content(holder))
+        finally:
+            frame.node.remove(holder)
+
+    def __close_stream_frame(
+        self,
+        writer: "StreamWriter",
+        frame: "StreamFrame",
+        context: "ContentFileContext",
+    ) -> None:
+        """Write the rest of a streamed element and its end tag."""
+        self.__next_stream_child(writer, frame, context)
+        if frame.opened:
+            end_tags = frame.start_tags
+        elif frame.empty_div:
+            # Empty elements are written as calibre writes them
+            end_tags = frame.start_tags[:-1]
+            for start_tag in end_tags:
+                writer.write(start_tag + b">")
+            writer.write(frame.empty_div)
+        else:
+            writer.write(writer.serialize(frame.node))
+            return
+        for start_tag in reversed(end_tags):
+            writer.write(_end_tag(start_tag))
+
+    def __write_stream_child(
+        self,
+        frame: "StreamFrame",
+        holder: etree._Element,
+        context: "ContentFileContext",
+    ) -> None:
+        """Move the last complete child of a streamed element to its holder."""
+        node = frame.pending
+        if node is None:
+            return
+        frame.pending = None
+        tail = node.tail
+        node.tail = None
+
+        if frame.pending_written:
+            frame.node.remove(node)
+        else:
+            if frame.references and node.tag == f"{{{XHTML_NAMESPACE}}}head":
+                if self.__add_content_file_reference_to_root(
+                    frame.node, context.name, *frame.references
+                ):
+                    frame.referenced = True
+                frame.references = []
+            if frame.spans:
+                # The child is converted detached, as the span walker does with
+                # the children of the body
+                frame.node.remove(node)
+                node = self._add_kobo_spans_to_node(node, context.name)
+            holder.append(node)
+
+        if frame.pending_tail:
+            self.__write_stream_text(frame, holder, tail, context)
+
+    def __write_stream_text(
+        self,
+        frame: "StreamFrame",
+        holder: etree._Element,
+        text: Optional[str],
+        context: "ContentFileContext",
+    ) -> None:
+        """Add text in a streamed element to its holder, as Kobo spans if needed."""
+        if text is None:
+            return
+        if frame.spans and self.__append_kobo_spans_from_text(holder, text, context):
+            context.paragraph += 1
+        elif len(holder):
+            holder[-1].tail = text
+        else:
+            holder.text = text
+
+    def __run_async(self, func: Callable, args: List[Tuple[Any, ...]]) -> None:
+        if self.executor == EXECUTOR_SERIAL:
+            for arg in args:
+                func(*arg)
+            return
+
+        args = self.__longest_first(args, lambda arg: arg[0])
+        try:
+            worker_pool.run(func, [(arg, self.__time_budget(arg[0])) for arg in args])
+        except TimeoutError as e:
+            self.__discard_unfinished(getattr(e, "unfinished", []))
+            raise
+
+    def __discard_unfinished(self, names: List[str]) -> None:
+        """Drop the changes of tasks which ran out of time.
+
+        The tasks may still be running and changing the trees and conversion
+        state they hold, so these are dropped from the container; the tasks
+        can't make any further changes (see check_task_cancelled()).
+        """
+        for name in names:
+            with self.__file_lock(name):
+                self.parsed_cache.pop(name, None)
+                self.dirtied.discard(name)
+                self.__committed.discard(name)
+                self.__track_parsed(name)
+            with self.__contexts_lock:
+                self.__contexts.pop(name, None)
+
+    def __content_size(self, name: str) -> int:
+        """Get the uncompressed size of a file, the estimated cost to process it."""
+        try:
+            if self.__in_store(name):
+                return self.__store.size(name)
+            return os.path.getsize(self.name_path_map[name])
+        except (KeyError, OSError):
+            return 0
+
+    def __longest_first(self, items: List[Any], key: Callable) -> List[Any]:
+        """Order work so that the costliest files are started first.
+
+        Started in manifest order, a single large chapter at the end of a book
+        leaves one worker busy long after all others finished; started first,
+        the small files fill the other workers in the meantime. The sort is
+        stable, so equally sized files keep their manifest order.
+        """
+        return sorted(items, key=lambda item: -self.__content_size(key(item)))
+
+    def __time_budget(self, name: str) -> float:
+        """Get the time allowed for processing a single file."""
+        size = self.__content_size(name)
+        return TASK_TIME_BUDGET + TASK_TIME_BUDGET_PER_MB * size / (1024 * 1024)
 
     def __run_async_over_content(
-        self, func: Callable, args: Optional[Tuple[str, ...]] = None
+        self, func: Callable, args: Optional[Tuple[Any, ...]] = None
     ) -> None:
         args = args or ()
         names = [(name,) + args for name in self.html_names()]
         self.__run_async(func, names)
 
+    def __run_stage(
+        self, func: Callable, args: Optional[Tuple[Any, ...]] = None
+    ) -> None:
+        """Run func over every content file, then flush all changes once."""
+        self.__run_async_over_content(func, args)
+        self.flush_cache()
+
     def convert(self) -> None:
         """The entry point for converting to KePub"""
-        self.__run_async_over_content(self.add_kobo_spans)
-        self.__run_async_over_content(self.add_kobo_divs)
+        self.queue_content_pass("add_kobo_spans")
+        self.queue_content_pass("add_kobo_divs")
+        self.run_content_passes()
 
     def add_kobo_divs(self, name) -> None:
         """Add KePub divs to the HTML file."""
-        self.log.debug(f"Adding Kobo divs to {name}")
+        self.__add_kobo_divs_impl(name)
+        self.flush_cache([name])
+
+    def __add_kobo_divs_impl(self, name: str) -> None:
         root = self.parsed(name)
-        kobo_div_count = int(
-            root.xpath(
-                'count(//xhtml:div[@id="book-inner"])',
-                namespaces={"xhtml": XHTML_NAMESPACE},
-            )
-        )
+        if self.__add_kobo_divs_to_root(root, name):
+            self.replace(name, root)
+
+    def __add_kobo_divs_to_root(self, root: etree._Element, name: str) -> bool:
+        self.log.debug(f"Adding Kobo divs to {name}")
+        census = self.__census(root, name)
+        if not self.__should_add_kobo_divs(
+            name, census["kobo_divs"], census["divs"], census["ps"]
+        ):
+            return False
+
+        self.__add_kobo_divs_to_body(root)
+        census["divs"] += 2
+        census["kobo_divs"] += 1
+        return True
+
+    def __census(self, root: etree._Element, name: str) -> Dict[str, int]:
+        """Get the element counts of a content file tree.
+
+        While content passes run over the tree the counts are computed once,
+        and kept up to date by the passes changing them.
+        """
+        context = self.content_context(name)
+        if context.root is not root:
+            return _census_tree(root)
+        if context.census is None:
+            context.census = _census_tree(root)
+        return context.census
+
+    def __should_add_kobo_divs(
+        self, name: str, kobo_div_count: int, div_count: int, p_count: int
+    ) -> bool:
         if kobo_div_count > 0:
             raise Exception(
                 _(f"Skipping file {name}")
@@ -407,12 +2435,6 @@ class KEPubContainer(EpubContainer):
         # spectacular way, so, err, don't ;).
         # FIXME: Try to figure out what's really happening instead of
         # sidestepping the issue?
-        div_count = int(
-            root.xpath("count(//xhtml:div)", namespaces={"xhtml": XHTML_NAMESPACE})
-        )
-        p_count = int(
-            root.xpath("count(//xhtml:p)", namespaces={"xhtml": XHTML_NAMESPACE})
-        )
         if div_count > p_count:
             self.log.warning(
                 _(f"Skipping file {name}")
@@ -424,69 +2446,68 @@ class KEPubContainer(EpubContainer):
                 + ngettext(f"{p_count} <p> tag", f"{p_count} <p> tags", p_count)
                 + ")"
             )
-            return
-
-        self.__add_kobo_divs_to_body(root)
+            return False
 
-        self.replace(name, root)
-        self.flush_cache()
+        return True
 
     def __add_kobo_divs_to_body(self, root: etree._Element) -> None:
         body = root.xpath("./xhtml:body", namespaces={"xhtml": XHTML_NAMESPACE})[0]
+        children = list(body)
 
-        # save node content for later
-        body_text = body.text
-        body_children = deepcopy(body.getchildren())
-        body_attrs = {}
-        for key in list(body.keys()):
-            body_attrs[key] = body.get(key)
-
-        # reset current node, to start from scratch
-        body.clear()
-
-        # restore node attributes
-        for key in body_attrs:
-            body.set(key, body_attrs[key])
-
-        # Wrap the full body in a div
-        inner_div = etree.Element(
-            f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-inner"}
+        # Wrap the full body in two divs. They are created inside the body, as
+        # moving every child into a div of another document is slow.
+        outer_div = etree.SubElement(
+            body, f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-columns"}
         )
-
-        # Handle the node text
-        if body_text is not None:
-            inner_div.text = body_text
-
-        # re-add the node children, but as children of the div
-        for child in body_children:
-            # save child tail for later
-            child_tail = child.tail
-            child.tail = None
-            inner_div.append(child)
-            # Handle the child tail
-            if child_tail is not None:
-                inner_div[-1].tail = child_tail
-
-        # Finally, wrap that div in another one...
-        outer_div = etree.Element(
-            f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-columns"}
+        inner_div = etree.SubElement(
+            outer_div, f"{{{XHTML_NAMESPACE}}}div", attrib={"id": "book-inner"}
         )
-        outer_div.append(inner_div)
 
-        # And re-chuck the full div pyramid in the now empty body
-        body.append(outer_div)
+        # Move the body text and children into the div; each child keeps its
+        # tail when it is moved
+        inner_div.text = body.text
+        body.text = None
+        body.tail = None
+        for child in children:
+            inner_div.append(child)
 
     def add_kobo_spans(self, name: str) -> None:
         """Add KePub spans (used for in-book location) the HTML file."""
-        self.log.debug(f"Adding Kobo spans to {name}")
+        self.__add_kobo_spans_impl(name)
+        self.flush_cache([name])
+
+    def __add_kobo_spans_impl(self, name: str) -> None:
         root = self.parsed(name)
-        kobo_span_count = int(
-            root.xpath(
-                'count(.//xhtml:span[@class="koboSpan" '
-                + 'or starts-with(@id, "kobo.")])',
-                namespaces={"xhtml": XHTML_NAMESPACE},
-            )
-        )
+        if self.__add_kobo_spans_to_root(root, name):
+            self.replace(name, root)
+
+    def __add_kobo_spans_to_root(self, root: etree._Element, name: str) -> bool:
+        self.log.debug(f"Adding Kobo spans to {name}")
+        census = self.__census(root, name)
+        self.__check_no_kobo_spans(name, census["kobo_spans"])
+
+        body = root.xpath("./xhtml:body", namespaces={"xhtml": XHTML_NAMESPACE})[0]
+        # Segment the text of the whole document in one go before walking it.
+        # This includes some text the walker skips, which is cheaper than
+        # walking the tree twice.
+        texts = list(dict.fromkeys(text for text in body.itertext() if text.strip()))
+        context = self.content_context(name)
+        context.segments = dict(zip(texts, self.segmenter.split_texts(texts)))
+        paragraph = context.paragraph
+        try:
+            self._add_kobo_spans_to_node(body, name)
+        finally:
+            context.segments = {}
+        if context.paragraph > paragraph:
+            # Only whether there are any Kobo spans matters
+            census["kobo_spans"] += 1
+        return True
+
+    def __check_head(self, name: str, head_count: int) -> None:
+        if head_count == 0:
+            raise Exception(_(f"Could not find a <head> element in {name}"))
+
+    def __check_no_kobo_spans(self, name: str, kobo_span_count: int) -> None:
         if kobo_span_count > 0:
             raise Exception(
                 _(f"Skipping file {name}")
@@ -498,91 +2519,130 @@ class KEPubContainer(EpubContainer):
                 )
             )
 
-        body = root.xpath("./xhtml:body", namespaces={"xhtml": XHTML_NAMESPACE})[0]
-        self._add_kobo_spans_to_node(body, name)
-
-        self.replace(name, root)
-        self.flush_cache()
-
     def _add_kobo_spans_to_node(
         self, node: etree._Element, name: str
     ) -> etree._Element:
+        """Add Kobo spans to the text of a node and all of its descendants.
+
+        The tree is rewritten in place, depth-first, with an explicit stack so
+        deeply nested markup can't hit the recursion limit. Nodes are moved
+        rather than copied. Returns the node, or the span wrapping it if the
+        node itself had to be wrapped.
+        """
+        context = self.content_context(name)
+        node, children = self.__open_kobo_span_node(node, context)
+        if children is None:
+            return node
+
+        # Each stack entry holds a node whose children are being processed,
+        # the children still left to process, and the node's own tail, which
+        # gets its spans once everything inside the node is done.
+        stack = [
+            (node, iter(children), None)
+        ]  # type: List[Tuple[etree._Element, Iterator[etree._Element], Optional[str]]]
+        while stack:
+            parent, remaining, _tail = stack[-1]
+            child = next(remaining, None)
+            if child is None:
+                _parent, _remaining, tail = stack.pop()
+                if tail is not None:
+                    self.__append_kobo_spans_from_tail(stack[-1][0], tail, context)
+                continue
+
+            # save child tail for later
+            child_tail = child.tail
+            child.tail = None
+            child, grandchildren = self.__open_kobo_span_node(child, context)
+            parent.append(child)
+            if grandchildren is not None:
+                stack.append((child, iter(grandchildren), child_tail))
+            elif child_tail is not None:
+                self.__append_kobo_spans_from_tail(parent, child_tail, context)
+
+        return node
+
+    def __open_kobo_span_node(
+        self, node: etree._Element, context: "ContentFileContext"
+    ) -> Tuple[etree._Element, Optional[List[etree._Element]]]:
+        """Start adding Kobo spans to a detached node.
+
+        Converts the node text to spans and detaches the node children, which
+        are returned to be processed and re-added in order. Returns None
+        instead of the children if they must be left alone, along with the node
+        to add to the parent in place of this one.
+        """
+        name = context.name
         # process node only if it is not a comment or a processing instruction
-        if (
-            node is None
-            or isinstance(node, etree._Comment)
-            or isinstance(node, etree._ProcessingInstruction)
-        ):
-            if node is not None:
-                node.tail = None
+        if node is None:
+            return node, None
+        tag = node.tag
+        if tag is etree.Comment or tag is etree.ProcessingInstruction:
+            node.tail = None
             self.log.debug(f"[{name}] Skipping comment/ProcessingInstruction node")
-            return node
+            return node, None
 
         # Special case some tags
-        special_tag_match = re.search(r"^(?:\{[^\}]+\})?(\w+)$", node.tag)
-        if special_tag_match:
+        tag_class = classify_tag(tag)
+        if tag_class == TAG_SKIP:
             # Skipped tags are just flat out skipped
-            if special_tag_match.group(1) in SKIPPED_TAGS:
-                self.log.debug(f"[{name}] Skipping '{special_tag_match.group(1)}' tag")
-                return node
+            self.log.debug(f"[{name}] Skipping '{local_tag_name(tag)}' tag")
+            return node, None
 
+        if tag_class == TAG_WRAP:
             # Special tags get wrapped in a span and their children are ignored
-            if special_tag_match.group(1) in SPECIAL_TAGS:
-                self.log.debug(
-                    f"[{name}] Wrapping '{special_tag_match.group(1)}' tag and "
-                    + "ignoring children"
-                )
-                span = etree.Element(
-                    f"{{{XHTML_NAMESPACE}}}span",
-                    attrib={
-                        "id": f"kobo.{self.paragraph_counter[name]}.1",
-                        "class": "koboSpan",
-                    },
-                )
-                span.append(node)
-                return span
+            self.log.debug(
+                f"[{name}] Wrapping '{local_tag_name(tag)}' tag and "
+                + "ignoring children"
+            )
+            span = etree.Element(
+                f"{{{XHTML_NAMESPACE}}}span",
+                attrib={
+                    "id": f"kobo.{context.paragraph}.1",
+                    "class": "koboSpan",
+                },
+            )
+            span.append(node)
+            return span, None
 
-        # save node content for later
+        # detach the node content, the children keep their tails
         node_text = node.text
-        node_children = deepcopy(node.getchildren())
-        node_attrs = {}
-        for key in list(node.keys()):
-            node_attrs[key] = node.get(key)
-
-        # reset current node, to start from scratch
-        node.clear()
-
-        # restore node attributes
-        for key in node_attrs:
-            node.set(key, node_attrs[key])
+        node_children = list(node)
+        node.text = None
+        node.tail = None
+        for child in node_children:
+            node.remove(child)
 
         # the node text is converted to spans
         if node_text is not None:
-            if not self._append_kobo_spans_from_text(node, node_text, name):
+            if not self.__append_kobo_spans_from_text(node, node_text, context):
                 # didn't add spans, restore text
                 node.text = node_text
             else:
-                self.paragraph_counter[name] += 1
+                context.paragraph += 1
 
-        # re-add the node children
-        for child in node_children:
-            # save child tail for later
-            child_tail = child.tail
-            child.tail = None
-            node.append(self._add_kobo_spans_to_node(child, name))
-            # the child tail is converted to spans
-            if child_tail is not None:
-                if not self._append_kobo_spans_from_text(node, child_tail, name):
-                    # didn't add spans, restore tail on last child
-                    node[-1].tail = child_tail
-                else:
-                    self.paragraph_counter[name] += 1
+        return node, node_children
 
-        return node
+    def __append_kobo_spans_from_tail(
+        self, node: etree._Element, tail: str, context: "ContentFileContext"
+    ) -> None:
+        """Convert the tail of the last child of node to spans."""
+        if not self.__append_kobo_spans_from_text(node, tail, context):
+            # didn't add spans, restore tail on last child
+            node[-1].tail = tail
+        else:
+            context.paragraph += 1
 
     def _append_kobo_spans_from_text(
         self, node: etree._Element, text: str, name: str
-    ) -> etree._Element:
+    ) -> bool:
+        return self.__append_kobo_spans_from_text(
+            node, text, self.content_context(name)
+        )
+
+    def __append_kobo_spans_from_text(
+        self, node: etree._Element, text: str, context: "ContentFileContext"
+    ) -> bool:
+        name = context.name
         if not text:
             self.log.error(f"[{name}] No text passed, can't add spans")
             return False
@@ -592,26 +2652,466 @@ class KEPubContainer(EpubContainer):
             self.log.warning(f"[{name}] Found only whitespace, not adding spans")
             return False
 
-        # split text in sentences
-        groups = TEXT_SPLIT_RE.split(text)
-        # remove empty strings resulting from split()
-        groups = [g for g in groups if g != ""]
+        # split text in sentences, unless it was already split with the rest of
+        # the document
+        groups = context.segments.get(text)
+        if groups is None:
+            groups = self.segmenter.split(text)
 
         # TODO: To match Kobo KePubs, the trailing whitespace needs to
         # be prepended to the next group. Probably equivalent to make
         # sure the space stays in the span at the end.
         # add each sentence in its own span
-        segment_counter = 1
-        for g in groups:
-            span = etree.Element(
+        paragraph = context.paragraph
+        for segment_counter, g in enumerate(groups, 1):
+            span = etree.SubElement(
+                node,
                 f"{{{XHTML_NAMESPACE}}}span",
                 attrib={
                     "class": "koboSpan",
-                    "id": f"kobo.{self.paragraph_counter[name]}.{segment_counter}",
+                    "id": f"kobo.{paragraph}.{segment_counter}",
                 },
             )
             span.text = g
-            node.append(span)
-            segment_counter += 1
 
         return True
+
+
+_tag_classes = {}  # type: Dict[str, str]
+
+
+def classify_tag(tag: str) -> str:
+    """Get how the span walker handles a Clark notation tag.
+
+    Tags are classified once per process and looked up afterwards, as the same
+    few tags repeat across every element of every book.
+    """
+    tag_class = _tag_classes.get(tag)
+    if tag_class is None:
+        tag_class = TAG_DESCEND
+        match = TAG_NAME_RE.search(tag)
+        if match:
+            if match.group(1) in SKIPPED_TAGS:
+                tag_class = TAG_SKIP
+            elif match.group(1) in SPECIAL_TAGS:
+                tag_class = TAG_WRAP
+        _tag_classes[tag] = tag_class
+    return tag_class
+
+
+def classify_media_type(media_type: Optional[str]) -> str:
+    """Get the kind of file a media type is for compression policies.
+
+    Files are markup or other text, media (images, audio and video), fonts, or
+    anything else. SVG images are markup.
+    """
+    if not media_type:
+        return "other"
+    if (
+        media_type in HTML_MIMETYPES
+        or media_type.startswith("text/")
+        or media_type.endswith(("+xml", "/xml"))
+        or media_type in {"application/javascript", "application/json"}
+    ):
+        return "markup"
+    if media_type.startswith(("image/", "audio/", "video/")):
+        return "media"
+    if (
+        media_type.startswith("font/")
+        or "font" in media_type.partition("/")[2]
+        or media_type == "application/vnd.ms-opentype"
+    ):
+        return "font"
+    return "other"
+
+
+def local_tag_name(tag: str) -> str:
+    """Get a tag name without its namespace."""
+    return tag.rpartition("}")[2]
+
+
+def _is_kobo_span(node: etree._Element) -> bool:
+    return node.get("class") == "koboSpan" or node.get("id", "").startswith("kobo.")
+
+
+def _census_tree(root: etree._Element) -> Dict[str, int]:
+    """Count the elements checked before adding references, Kobo spans and divs.
+
+    lxml iterates over the elements with a given tag without creating Python
+    objects for any other element, which makes this about twice as fast as
+    counting with XPath.
+    """
+    counts = defaultdict(int)  # type: Dict[str, int]
+    counts["heads"] = sum(
+        1 for _node in root.iterchildren(f"{{{XHTML_NAMESPACE}}}head")
+    )
+    for node in root.iter(f"{{{XHTML_NAMESPACE}}}span"):
+        if _is_kobo_span(node):
+            counts["kobo_spans"] += 1
+    for node in root.iter(f"{{{XHTML_NAMESPACE}}}div"):
+        counts["divs"] += 1
+        if node.get("id") == "book-inner":
+            counts["kobo_divs"] += 1
+    counts["ps"] = sum(1 for _node in root.iter(f"{{{XHTML_NAMESPACE}}}p"))
+    return counts
+
+
+def _count_stream_elements(data: bytes) -> Dict[str, int]:
+    """Count the elements checked before adding references, Kobo spans and divs.
+
+    Raises etree.XMLSyntaxError if the data isn't well-formed XML.
+    """
+    span_tag = f"{{{XHTML_NAMESPACE}}}span"
+    div_tag = f"{{{XHTML_NAMESPACE}}}div"
+    p_tag = f"{{{XHTML_NAMESPACE}}}p"
+    head_tag = f"{{{XHTML_NAMESPACE}}}head"
+    counts = defaultdict(int)  # type: Dict[str, int]
+    for _event, node in etree.iterparse(BytesIO(data), huge_tree=True):
+        tag = node.tag
+        if tag == span_tag:
+            if _is_kobo_span(node):
+                counts["kobo_spans"] += 1
+        elif tag == div_tag:
+            counts["divs"] += 1
+            if node.get("id") == "book-inner":
+                counts["kobo_divs"] += 1
+        elif tag == p_tag:
+            counts["ps"] += 1
+        elif tag == head_tag:
+            parent = node.getparent()
+            if parent is not None and parent.getparent() is None:
+                counts["heads"] += 1
+
+        # Drop everything already counted
+        node.clear(keep_tail=True)
+        parent = node.getparent()
+        if parent is not None:
+            while node.getprevious() is not None:
+                del parent[0]
+    return counts
+
+
+def _stream_fallback_reason(data: bytes) -> Optional[str]:
+    """Get why a content file can't be streamed, or None if it can be.
+
+    A streamed file is parsed as XML, so it must have no entities other than
+    those of XML, which calibre would parse as HTML, and its root must be an
+    XHTML html element, which calibre moves other roots into. No element but
+    the root may declare namespaces, as lxml moves and drops declarations as
+    the Kobo spans and divs are added, and declares them again on elements
+    serialized on their own (see StreamWriter). This is checked before
+    anything but the first element is parsed.
+    """
+    match = UNSTREAMABLE_ENTITY_RE.search(data)
+    if match is not None:
+        return "it has entity references"
+    try:
+        for _event, node in etree.iterparse(
+            BytesIO(data), events=("start",), huge_tree=True
+        ):
+            if node.tag != f"{{{XHTML_NAMESPACE}}}html":
+                return "its root isn't an XHTML html element"
+            break
+        else:
+            return "it has no root element"
+    except etree.XMLSyntaxError as e:
+        return str(e)
+
+    match = HTML_START_TAG_RE.search(data)
+    if match is None or data.find(b"xmlns", data.find(b">", match.start())) != -1:
+        return "it declares namespaces below its root"
+    return None
+
+
+def _start_tag(data: bytes) -> bytes:
+    """Get the start tag of a serialized element, without ">"."""
+    end = data.index(b">")
+    if data.endswith(b"/", 0, end):
+        end -= 1
+    return data[:end]
+
+
+def _end_tag(start_tag: bytes) -> bytes:
+    """Get the end tag matching a start tag."""
+    return b"</" + start_tag[1:].split(None, 1)[0] + b">"
+
+
+class ContentWorkerPool:
+    """A long-lived worker pool shared by every KEPubContainer.
+
+    Workers are reused across stages and books instead of being started and
+    stopped for every stage. After each batch of thread tasks the number of
+    threads is adjusted to the parallelism the batch actually achieved (the
+    CPU time used by all tasks divided by the elapsed time): pure-Python work
+    contends for the GIL and gains nothing from more threads, while work which
+    releases the GIL can keep one thread per core busy.
+    """
+
+    def __init__(self) -> None:
+        self.max_workers = min(32, (os.cpu_count() or 1) + 4)
+        self.thread_workers = self.max_workers
+        self.__lock = threading.Lock()
+        self.__active_batches = 0
+        self.__parallelism = None  # type: Optional[float]
+        self.__threads = None  # type: Optional[ThreadPoolExecutor]
+        self.__processes = None  # type: Optional[ProcessPoolExecutor]
+
+    def run(
+        self,
+        func: Callable,
+        tasks: List[Tuple[Tuple[Any, ...], float]],
+        processes: bool = False,
+    ) -> List[Any]:
+        """Run func once for each task, returning the results in task order.
+
+        Each task is a tuple of the arguments to call func with, the first of
+        which names the task in errors, and the time budget for the task. If
+        processes is True, the tasks run in worker processes, so func and its
+        arguments must be picklable. The first failure, in task order, is
+        raised once every task finished or a task ran over its time budget.
+
+        Tasks share the workers, so a task's time is counted as its share of
+        the time its worker could run: while more thread tasks run than one
+        (the GIL), or more process tasks than there are CPUs, each is only
+        charged for its part of the elapsed time. When a task runs over its
+        budget a TimeoutError is raised, whose unfinished attribute names the
+        tasks which didn't finish. Thread tasks can't be stopped, so they are
+        cancelled instead: any KEPubContainer change they try from then on
+        raises TaskCancelled.
+        """
+        if not tasks:
+            return []
+
+        with self.__lock:
+            self.__active_batches += 1
+            if processes:
+                executor = self.__process_executor()
+            else:
+                executor = self.__thread_executor()
+
+        cancelled = threading.Event()
+        try:
+            start = time.monotonic()
+            if processes:
+                futures = [executor.submit(func, *args) for args, _budget in tasks]
+                capacity = float(os.cpu_count() or 1)
+            else:
+                futures = [
+                    executor.submit(_timed_call, func, cancelled, *args)
+                    for args, _budget in tasks
+                ]
+                capacity = 1.0
+            self.__wait(futures, tasks, capacity, cancelled)
+            results = [future.result() for future in futures]
+            elapsed = time.monotonic() - start
+        finally:
+            with self.__lock:
+                self.__active_batches -= 1
+
+        if processes:
+            return results
+
+        self.__resize(sum(cpu_time for _result, cpu_time in results), elapsed, tasks)
+        return [result for result, _cpu_time in results]
+
+    def imap(self, func: Callable, *iterables: Iterable[Any]) -> Iterator[Any]:
+        """Call func in worker threads like map(), yielding results in order.
+
+        Each result is yielded as soon as it and every result before it are
+        available. At most twice as many calls as there are threads are run
+        ahead of the results consumed, so finished results don't pile up.
+        """
+        with self.__lock:
+            self.__active_batches += 1
+            executor = self.__thread_executor()
+            window = 2 * self.thread_workers
+        pending: Deque[Future] = deque()
+        try:
+            for args in zip(*iterables):
+                pending.append(executor.submit(func, *args))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            with self.__lock:
+                self.__active_batches -= 1
+
+    def shutdown(self) -> None:
+        """Stop all workers. The pool starts new workers when next used."""
+        with self.__lock:
+            threads, self.__threads = self.__threads, None
+            processes, self.__processes = self.__processes, None
+        if threads is not None:
+            threads.shutdown()
+        if processes is not None:
+            processes.shutdown()
+
+    def __thread_executor(self) -> Executor:
+        if self.__threads is None:
+            self.__threads = ThreadPoolExecutor(max_workers=self.thread_workers)
+        return self.__threads
+
+    def __process_executor(self) -> Executor:
+        if self.__processes is None:
+            self.__processes = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("fork"),
+            )
+        return self.__processes
+
+    def __wait(
+        self,
+        futures: List[Future],
+        tasks: List[Tuple[Tuple[Any, ...], float]],
+        capacity: float,
+        cancelled: threading.Event,
+    ) -> None:
+        budgets = {future: budget for future, (_args, budget) in zip(futures, tasks)}
+        names = {future: args[0] for future, (args, _budget) in zip(futures, tasks)}
+        used = defaultdict(float)  # type: Dict[Future, float]
+        pending = set(futures)
+        last = time.monotonic()
+        while pending:
+            _done, pending = wait(
+                pending, timeout=TASK_POLL_INTERVAL, return_when=ALL_COMPLETED
+            )
+            now = time.monotonic()
+            running = [future for future in pending if future.running()]
+            if running:
+                share = (now - last) * min(1.0, capacity / len(running))
+            last = now
+            for future in running:
+                used[future] += share
+                if used[future] > budgets[future]:
+                    cancelled.set()
+                    for other in pending:
+                        other.cancel()
+                    error = TimeoutError(
+                        _(
+                            f"Timed out after {budgets[future]:.0f} seconds "
+                            + f"processing {names[future]}"
+                        )
+                    )
+                    error.unfinished = [
+                        names[other] for other in futures if not other.done()
+                    ]
+                    raise error
+
+    def __resize(
+        self,
+        cpu_time: float,
+        elapsed: float,
+        tasks: List[Tuple[Tuple[Any, ...], float]],
+    ) -> None:
+        # Small batches say little about the work, so only use batches that
+        # gave every thread something to do for a measurable time.
+        if elapsed < 0.05 or len(tasks) < self.thread_workers:
+            return
+
+        parallelism = cpu_time / elapsed
+        if self.__parallelism is not None:
+            parallelism = (self.__parallelism + parallelism) / 2
+        self.__parallelism = parallelism
+
+        workers = max(
+            MIN_THREAD_WORKERS, min(self.max_workers, math.ceil(parallelism) + 1)
+        )
+        with self.__lock:
+            if workers == self.thread_workers or self.__active_batches > 0:
+                return
+            self.thread_workers = workers
+            threads, self.__threads = self.__threads, None
+        if threads is not None:
+            threads.shutdown(wait=False)
+
+
+class TaskCancelled(Exception):
+    """Raised in a worker task which ran over its time budget."""
+
+    pass
+
+
+# The cancellation event of the worker pool batch each thread is running a task
+# of, if any
+_task_state = threading.local()
+
+
+def _can_fork_workers() -> bool:
+    """Determine if worker processes can be forked on this platform.
+
+    Calibre's processes run several threads, and forking a threaded process
+    without exec can deadlock on locks held by other threads. On macOS system
+    libraries make this unsafe, which is why Python spawns processes there by
+    default, so forked workers are only used on Linux.
+    """
+    return (
+        sys.platform.startswith("linux")
+        and "fork" in multiprocessing.get_all_start_methods()
+    )
+
+
+def _timed_call(func: Callable, cancelled: threading.Event, *args) -> Tuple[Any, float]:
+    """Call func, returning its result and the CPU time the call used.
+
+    While func runs, check_task_cancelled() raises once cancelled is set.
+    """
+    _task_state.cancelled = cancelled
+    start = time.thread_time()
+    try:
+        result = func(*args)
+    finally:
+        _task_state.cancelled = None
+    return result, time.thread_time() - start
+
+
+def check_task_cancelled() -> None:
+    """Raise TaskCancelled if the current worker task was cancelled."""
+    cancelled = getattr(_task_state, "cancelled", None)
+    if cancelled is not None and cancelled.is_set():
+        raise TaskCancelled(_("The task was cancelled after running out of time"))
+
+
+worker_pool = ContentWorkerPool()
+
+
+def shutdown_worker_pool() -> None:
+    """Stop the shared worker pool, for example at the end of a device session."""
+    worker_pool.shutdown()
+
+
+class KEPubContentWorker(KEPubContainer):
+    """Runs content passes over single content files outside of a container.
+
+    No book is loaded; the worker only knows the MIME types it is given, which
+    must include the content file being transformed and any file referenced by
+    the content passes.
+    """
+
+    def __init__(
+        self,
+        log,
+        mime_map: Dict[str, str],
+        language: Optional[str] = None,
+        streaming_threshold: int = STREAMING_THRESHOLD,
+    ) -> None:
+        self._init_content_state(log, EXECUTOR_SERIAL)
+        ContainerBase.__init__(self, log)
+        self.mime_map.update(mime_map)
+        self.set_language(language)
+        self.streaming_threshold = streaming_threshold
+
+
+def _run_content_passes_in_worker(
+    name: str,
+    data: bytes,
+    mime_map: Dict[str, str],
+    language: Optional[str],
+    passes: List[Tuple[str, Tuple[str, ...]]],
+    streaming_threshold: int = STREAMING_THRESHOLD,
+) -> Tuple[Optional[bytes], int]:
+    worker = KEPubContentWorker(default_log, mime_map, language, streaming_threshold)
+    data = worker._transform_content_data(name, data, passes)
+    return data, worker.content_context(name).paragraph
@@ -21,6 +21,7 @@ from calibre.ebooks.metadata.book.base import Metadata
 from calibre.ebooks.metadata.book.base import NULL_VALUES
 
 from calibre_plugins.kepubout import common
+from calibre_plugins.kepubout.container import BACKEND_MEMORY
 from calibre_plugins.kepubout.container import KEPubContainer
 
 
@@ -118,6 +119,40 @@ class KEPubOutput(OutputFormatPlugin):
                 ]
             ),
         ),
+        OptionRecommendation(
+            name="kepub_compression_policy",
+            recommended_value="default",
+            choices=["default", "balanced", "fast", "smallest"],
+            help=" ".join(
+                [
+                    _(  # noqa: F821
+                        "Sets how files changed by the conversion are compressed."
+                    ),
+                    _(  # noqa: F821
+                        "balanced and fast don't compress images and fonts again, "
+                        + "fast also compresses text less, and smallest makes the "
+                        + "smallest books at the cost of more conversion time."
+                    ),
+                ]
+            ),
+        ),
+        OptionRecommendation(
+            name="kepub_executor",
+            recommended_value="thread",
+            choices=["serial", "thread", "process"],
+            help=" ".join(
+                [
+                    _(  # noqa: F821
+                        "Sets how work is spread over the content files of a book."
+                    ),
+                    _(  # noqa: F821
+                        "Use process to run conversion passes on all CPU cores, "
+                        + "which is fastest for large books on Linux; elsewhere "
+                        + "threads are used instead."
+                    ),
+                ]
+            ),
+        ),
     }
     kepub_recommendations: Set[Tuple[str, Any, int]] = {
         ("epub_version", "3", OptionRecommendation.LOW)
@@ -147,7 +182,15 @@ class KEPubOutput(OutputFormatPlugin):
             oeb_book, output, input_plugin, opts, common.log
         )
         common.log.debug("Done ePub conversion")
-        container = KEPubContainer(output, common.log, opts.kepub_clean_markup)
+        container = KEPubContainer(
+            output,
+            common.log,
+            opts.kepub_clean_markup,
+            fused=True,
+            executor=opts.kepub_executor,
+            backend=BACKEND_MEMORY,
+            compression=opts.kepub_compression_policy,
+        )
 
         if container.is_drm_encumbered:
             common.log.error("DRM-encumbered container, skipping conversion")
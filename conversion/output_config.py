@@ -49,12 +49,15 @@ class PluginWidget(EPUBPluginWidget, EPUBUIForm):
                 "kepub_hyphenate_chars_before",
                 "kepub_hyphenate_chars_after",
                 "kepub_hyphenate_limit_lines",
+                "kepub_compression_policy",
             ),
         )
         self.opt_no_svg_cover.toggle()
         self.opt_no_svg_cover.toggle()
         ev = get_option("epub_version")
         self.opt_epub_version.addItems(list(ev.option.choices))
+        cp = get_option("kepub_compression_policy")
+        self.opt_kepub_compression_policy.addItems(list(cp.option.choices))
         self.db, self.book_id = db, book_id
         self.initialize_options(get_option, get_help, db, book_id)
 
@@ -201,6 +204,22 @@ class PluginWidget(EPUBPluginWidget, EPUBUIForm):
         self.opt_kepub_clean_markup.setText(_("Clean up ePub markup"))  # noqa: F821
         self.gridLayout.addWidget(self.opt_kepub_clean_markup, rows, 0, 1, 1)
 
+        rows += 1
+
+        self.opt_kepub_compression_policy_label = QtGui.QLabel(Form)
+        self.opt_kepub_compression_policy_label.setText(
+            _("Compression policy") + ":"  # noqa: F821
+        )
+        self.gridLayout.addWidget(
+            self.opt_kepub_compression_policy_label, rows, 0, 1, 1
+        )
+        self.opt_kepub_compression_policy = QtGui.QComboBox(Form)
+        self.opt_kepub_compression_policy.setObjectName("opt_kepub_compression_policy")
+        self.opt_kepub_compression_policy_label.setBuddy(
+            self.opt_kepub_compression_policy
+        )
+        self.gridLayout.addWidget(self.opt_kepub_compression_policy, rows, 1, 1, 1)
+
         # Next options here
 
         rows += 1
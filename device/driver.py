@@ -17,7 +17,12 @@ from calibre.constants import config_dir
 from calibre.devices.kobo.driver import KOBOTOUCH
 from calibre.ebooks.oeb.polish.errors import DRMError
 from calibre_plugins.kobotouch_extended import common
+from calibre_plugins.kobotouch_extended.container import BACKEND_MEMORY
+from calibre_plugins.kobotouch_extended.container import COMPRESSION_DEFAULT
+from calibre_plugins.kobotouch_extended.container import COMPRESSION_POLICIES
 from calibre_plugins.kobotouch_extended.container import KEPubContainer
+from calibre_plugins.kobotouch_extended.container import TransformCache
+from calibre_plugins.kobotouch_extended.container import shutdown_worker_pool
 from polyglot.builtins import is_py3
 
 if is_py3:
@@ -33,6 +38,11 @@ except NameError:
 
 EPUB_EXT = ".epub"
 KEPUB_EXT = ".kepub"
+DRIVER_INFO_NAME = "driverinfo.kte"
+
+# Converted books and content files, shared by every device session
+conversion_cache = common.ConversionCache()
+transform_cache = TransformCache(common.PLUGIN_VERSION)
 
 
 class InvalidEPub(ValueError):
@@ -205,10 +215,56 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
                 + "exceptions"
             )
 
+        conversion_opts = {
+            "hyphenate": self.hyphenate and not self.disable_hyphenation,
+            "hyphen_min_chars": self.hyphenate_chars,
+            "hyphen_min_chars_before": self.hyphenate_chars_before,
+            "hyphen_min_chars_after": self.hyphenate_chars_after,
+            "hyphen_limit_lines": self.hyphenate_limit_lines,
+            "no-hyphens": self.disable_hyphenation,
+            "smarten_punctuation": self.smarten_punctuation,
+            "extended_kepub_features": self.extra_features,
+        }
+
+        cache_key = None
+        if container is None and self.cache_conversions:
+            cache_key = conversion_cache.key(
+                infile, self.conversion_fingerprint(conversion_opts)
+            )
+            if conversion_cache.fetch(cache_key, infile):
+                common.log.info(
+                    "KoboTouchExtended:_modify_epub:Using cached conversion of "
+                    + f"{metadata.title}"
+                )
+                # The driver info belongs to this upload, not the cached one.
+                # The cleanup passes a fused container queues are never run,
+                # so no content file is converted again.
+                container = KEPubContainer(
+                    infile,
+                    common.log,
+                    fused=True,
+                    backend=BACKEND_MEMORY,
+                    compression=self.compression_policy,
+                )
+                self.add_driver_info(container, opts)
+                container.commit(outpath=infile)
+                if not self.extra_features:
+                    self.skip_renaming_files.add(metadata.uuid)
+                self.copy_generated_kepub(infile, metadata)
+                return True
+
         is_encumbered_book = False
         try:
             if container is None:
-                container = KEPubContainer(infile, common.log, self.clean_markup)
+                container = KEPubContainer(
+                    infile,
+                    common.log,
+                    self.clean_markup,
+                    fused=True,
+                    backend=BACKEND_MEMORY,
+                    compression=self.compression_policy,
+                    transform_cache=transform_cache if self.cache_conversions else None,
+                )
             else:
                 is_encumbered_book = container.is_drm_encumbered
         except DRMError:
@@ -228,59 +284,10 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
                 return False
 
         try:
-            # Add the conversion info file
-            calibre_details_file = self.normalize_path(
-                os.path.join(self._main_prefix, "driveinfo.calibre")
-            )
-            common.log.debug(
-                "KoboTouchExtended:_modify_epub:Calibre details file :: "
-                + calibre_details_file
-            )
-            o = {}
-            if os.path.isfile(calibre_details_file):
-                with open(calibre_details_file, "rb") as f:
-                    o = json.loads(f.read())
-                for prop in (
-                    "device_store_uuid",
-                    "prefix",
-                    "last_library_uuid",
-                    "location_code",
-                ):
-                    del o[prop]
-            else:
-                common.log.warning(
-                    "KoboTouchExtended:_modify_file:Calibre details file does "
-                    + "not exist!"
-                )
-            o["kobotouchextended_version"] = ".".join([str(n) for n in self.version])
-            o["kobotouchextended_options"] = str(opts.extra_customization)
-            o["kobotouchextended_currenttime"] = datetime.utcnow().ctime()
-            kte_data_file = self.temporary_file("_KoboTouchExtendedDriverInfo")
-            common.log.debug(
-                "KoboTouchExtended:_modify_epub:Driver data file :: {0}".format(
-                    kte_data_file.name
-                )
-            )
-            kte_data_file.write(json.dumps(o).encode("UTF-8"))
-            kte_data_file.close()
-            container.copy_file_to_container(
-                kte_data_file.name, name="driverinfo.kte", mt="application/json"
-            )
+            self.add_driver_info(container, opts)
 
             common.modify_epub(
-                container,
-                infile,
-                metadata=metadata,
-                opts={
-                    "hyphenate": self.hyphenate and not self.disable_hyphenation,
-                    "hyphen_min_chars": self.hyphenate_chars,
-                    "hyphen_min_chars_before": self.hyphenate_chars_before,
-                    "hyphen_min_chars_after": self.hyphenate_chars_after,
-                    "hyphen_limit_lines": self.hyphenate_limit_lines,
-                    "no-hyphens": self.disable_hyphenation,
-                    "smarten_punctuation": self.smarten_punctuation,
-                    "extended_kepub_features": self.extra_features,
-                },
+                container, infile, metadata=metadata, opts=conversion_opts, commit=False
             )
         except Exception as e:
             msg = "Failed to process {title} by {authors}: {msg}".format(
@@ -305,6 +312,77 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
         if not self.extra_features:
             self.skip_renaming_files.add(metadata.uuid)
 
+        # The base driver changes the same container, so the book is only
+        # written once, with every change applied
+        retval = super(KOBOTOUCHEXTENDED, self)._modify_epub(
+            infile, metadata, container
+        )
+        container.commit(outpath=infile)
+        if cache_key is not None and retval:
+            conversion_cache.store(cache_key, infile)
+
+        self.copy_generated_kepub(infile, metadata)
+
+        return retval
+
+    def add_driver_info(self, container, opts):
+        """Add the conversion info file, or replace the one already added.
+
+        The file records the time of the upload, so books taken from the
+        conversion cache get a new one.
+        """
+        calibre_details_file = self.normalize_path(
+            os.path.join(self._main_prefix, "driveinfo.calibre")
+        )
+        common.log.debug(
+            "KoboTouchExtended:_modify_epub:Calibre details file :: "
+            + calibre_details_file
+        )
+        o = {}
+        if os.path.isfile(calibre_details_file):
+            with open(calibre_details_file, "rb") as f:
+                o = json.loads(f.read())
+            for prop in (
+                "device_store_uuid",
+                "prefix",
+                "last_library_uuid",
+                "location_code",
+            ):
+                del o[prop]
+        else:
+            common.log.warning(
+                "KoboTouchExtended:_modify_file:Calibre details file does "
+                + "not exist!"
+            )
+        o["kobotouchextended_version"] = ".".join([str(n) for n in self.version])
+        o["kobotouchextended_options"] = str(opts.extra_customization)
+        o["kobotouchextended_currenttime"] = datetime.utcnow().ctime()
+        data = json.dumps(o).encode("UTF-8")
+        if DRIVER_INFO_NAME in container.name_path_map:
+            with container.open(DRIVER_INFO_NAME, "wb") as f:
+                f.write(data)
+        else:
+            container.copy_data_to_container(
+                data, DRIVER_INFO_NAME, mt="application/json"
+            )
+
+    def conversion_fingerprint(self, opts):
+        """Get everything a book's conversion depends on besides the book.
+
+        This is the conversion options, plus the options and device CSS used
+        by the base driver to modify books.
+        """
+        extra_css = os.path.join(self._main_prefix, self.KOBO_EXTRA_CSSFILE)
+        return dict(
+            opts,
+            clean_markup=self.clean_markup,
+            compression_policy=self.compression_policy,
+            modifying_css=bool(self.modifying_css()),
+            extra_css=common.file_hash(extra_css) if os.path.isfile(extra_css) else "",
+        )
+
+    def copy_generated_kepub(self, infile, metadata):
+        """Copy a converted book to the file copy directory, if one is set."""
         dpath = self.file_copy_dir or ""
         if dpath != "":
             dpath = os.path.expanduser(dpath).strip()
@@ -315,13 +393,6 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
             )
             shutil.copy(infile, dpath)
 
-        retval = super(KOBOTOUCHEXTENDED, self)._modify_epub(
-            infile, metadata, container
-        )
-        if retval:
-            container.commit(outpath=infile)
-        return retval
-
     def upload_books(self, files, names, on_card=None, end_session=True, metadata=None):
         """Process sending the book to the Kobo device."""
         if self.modifying_css():
@@ -397,9 +468,21 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
             with open(kobo_config_file, "w") as cfgfile:
                 cfg.write(cfgfile)
 
-        return super(KOBOTOUCHEXTENDED, self).upload_books(
-            files, names, on_card, end_session, metadata
-        )
+        # Books are converted as they are uploaded; the conversion worker pool
+        # is shared by all books in this upload and stopped once it is done.
+        conversion_cache.reset_stats()
+        try:
+            return super(KOBOTOUCHEXTENDED, self).upload_books(
+                files, names, on_card, end_session, metadata
+            )
+        finally:
+            shutdown_worker_pool()
+            stats = conversion_cache.stats
+            common.log.info(
+                "KoboTouchExtended:upload_books:Conversion cache "
+                + f"{stats['hits']} hits, {stats['misses']} misses, "
+                + f"{stats['stores']} stored, {stats['evictions']} evicted"
+            )
 
     def filename_callback(self, path, mi):
         """Ensure the filename on the device is correct."""
@@ -503,6 +586,8 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
         c.add_opt("hyphenate_chars_before", default=3)
         c.add_opt("hyphenate_chars_after", default=3)
         c.add_opt("hyphenate_limit_lines", default=2)
+        c.add_opt("compression_policy", default=COMPRESSION_DEFAULT)
+        c.add_opt("conversion_cache", default=True)
 
         # remove_opt verifies the preference is present first
         c.remove_opt("replace_lang")
@@ -699,3 +784,16 @@ class KOBOTOUCHEXTENDED(KOBOTOUCH):
             return "no-limit"
 
         return lines
+
+    @property
+    def cache_conversions(self):
+        """Determine if converted books are cached."""
+        return self.get_pref("conversion_cache")
+
+    @property
+    def compression_policy(self):
+        """Determine how files are compressed in converted books."""
+        policy = self.get_pref("compression_policy")
+        if policy not in COMPRESSION_POLICIES:
+            return COMPRESSION_DEFAULT
+        return policy
@@ -9,6 +9,7 @@ __docformat__ = "markdown en"
 
 import functools
 
+from PyQt5.Qt import QComboBox
 from PyQt5.Qt import QGridLayout
 from PyQt5.Qt import QLabel
 from PyQt5.Qt import QLineEdit
@@ -21,6 +22,7 @@ from calibre.gui2.device_drivers.tabbed_device_config import DeviceOptionsGroupB
 from calibre.gui2.device_drivers.tabbed_device_config import create_checkbox
 
 from calibre_plugins.kobotouch_extended import common
+from calibre_plugins.kobotouch_extended.container import COMPRESSION_POLICIES
 
 # Support load_translations() without forcing calibre 1.9+
 try:
@@ -78,6 +80,8 @@ class KOBOTOUCHEXTENDEDConfig(KOBOTOUCHConfig):
         p["hyphenate_chars_before"] = self.hyphenate_chars_before
         p["hyphenate_chars_after"] = self.hyphenate_chars_after
         p["hyphenate_limit_lines"] = self.hyphenate_limit_lines
+        p["compression_policy"] = self.compression_policy
+        p["conversion_cache"] = self.conversion_cache
 
         return p
 
@@ -289,12 +293,44 @@ class ExtendedGroupBox(DeviceOptionsGroupBox):
             device.get_pref("hyphenate_limit_lines")
         )
 
+        self.conversion_cache_checkbox = create_checkbox(
+            _("Cache converted books"),  # noqa: F821
+            _(  # noqa: F821
+                "Select this to keep converted books, so sending an unchanged "
+                + "book again with the same options doesn't convert it again."
+            ),
+            device.get_pref("conversion_cache"),
+        )
+
+        self.opt_kepub_compression_policy_label = QLabel(
+            _("Compression policy") + ":"  # noqa: F821
+        )
+
+        self.opt_kepub_compression_policy = QComboBox(self)
+        self.opt_kepub_compression_policy_label.setBuddy(
+            self.opt_kepub_compression_policy
+        )
+        self.opt_kepub_compression_policy.setObjectName("opt_kepub_compression_policy")
+        self.opt_kepub_compression_policy.setToolTip(
+            _(  # noqa: F821
+                "Select how files changed by the conversion are compressed. "
+                + "balanced and fast don't compress images and fonts again, fast "
+                + "also compresses text less, and smallest makes the smallest "
+                + "books at the cost of more conversion time."
+            )
+        )
+        self.opt_kepub_compression_policy.addItems(list(COMPRESSION_POLICIES))
+        self.opt_kepub_compression_policy.setCurrentText(
+            device.get_pref("compression_policy")
+        )
+
         self.options_layout.addWidget(self.extra_features_checkbox, 0, 0, 1, 1)
         self.options_layout.addWidget(self.upload_encumbered_checkbox, 0, 1, 1, 1)
         self.options_layout.addWidget(self.skip_failed_checkbox, 1, 0, 1, 1)
         self.options_layout.addWidget(self.hyphenate_checkbox, 1, 1, 1, 1)
         self.options_layout.addWidget(self.smarten_punctuation_checkbox, 2, 1, 1, 1)
         self.options_layout.addWidget(self.clean_markup_checkbox, 3, 0, 1, 1)
+        self.options_layout.addWidget(self.conversion_cache_checkbox, 3, 1, 1, 1)
         self.options_layout.addWidget(self.file_copy_dir_label, 4, 0, 1, 1)
         self.options_layout.addWidget(self.file_copy_dir_edit, 4, 1, 1, 1)
         self.options_layout.addWidget(self.full_page_numbers_checkbox, 5, 0, 1, 1)
@@ -313,7 +349,11 @@ class ExtendedGroupBox(DeviceOptionsGroupBox):
             self.opt_kepub_hyphenate_limit_lines_label, 9, 0, 1, 1
         )
         self.options_layout.addWidget(self.opt_kepub_hyphenate_limit_lines, 9, 1, 1, 1)
-        self.options_layout.setRowStretch(10, 2)
+        self.options_layout.addWidget(
+            self.opt_kepub_compression_policy_label, 10, 0, 1, 1
+        )
+        self.options_layout.addWidget(self.opt_kepub_compression_policy, 10, 1, 1, 1)
+        self.options_layout.setRowStretch(11, 2)
 
     @property
     def extra_features(self):
@@ -375,3 +415,12 @@ class ExtendedGroupBox(DeviceOptionsGroupBox):
     @property
     def hyphenate_limit_lines(self):
         return self.opt_kepub_hyphenate_limit_lines.value()
+
+    @property
+    def conversion_cache(self):
+        """Determine if converted books are cached."""
+        return self.conversion_cache_checkbox.isChecked()
+
+    @property
+    def compression_policy(self):
+        return self.opt_kepub_compression_policy.currentText()
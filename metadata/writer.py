@@ -63,28 +63,27 @@ class KEPUBMetadataWriter(EPUBMetadataWriter):
             common.log.debug(
                 "KEPUBMetadataWriter::set_metadata - cover_id={0}".format(cover_id)
             )
+            # Index the manifest items by ID and href in a single walk
+            by_id = {}
+            by_href = {}
             for item in reader.opf.itermanifest():
-                if item.get("id", None) == cover_id:
-                    mt = item.get("media-type", "")
-                    if mt and mt.startswith("image/"):
-                        common.log.debug(
-                            "KEPUBMetadataWriter::set_metadata - found cover"
-                        )
-                        item.set("properties", "cover-image")
-                        found_cover = True
-                        break
+                by_id.setdefault(item.get("id", None), item)
+                by_href.setdefault(item.get("href", None), item)
+            item = by_id.get(cover_id)
+            if item is not None and item.get("media-type", "").startswith("image/"):
+                common.log.debug("KEPUBMetadataWriter::set_metadata - found cover")
+                item.set("properties", "cover-image")
+                found_cover = True
             if not found_cover:
                 common.log.debug(
                     "KEPUBMetadataWriter::set_metadata - looking for cover "
                     + "using href"
                 )
-                for item in reader.opf.itermanifest():
-                    if item.get("href", None) == cover_id:
-                        mt = item.get("media-type", "")
-                        if mt and mt.startswith("image/"):
-                            common.log("KEPUBMetadataWriter::set_metadata -found cover")
-                            item.set("properties", "cover-image")
-                            found_cover = True
+                item = by_href.get(cover_id)
+                if item is not None and item.get("media-type", "").startswith("image/"):
+                    common.log("KEPUBMetadataWriter::set_metadata -found cover")
+                    item.set("properties", "cover-image")
+                    found_cover = True
 
             if found_cover:
                 opfbytes = reader.read_bytes(reader.opf_path)
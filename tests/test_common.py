@@ -4,8 +4,11 @@
 # anything from calibre or the plugins yet.
 import glob
 import os
+import shutil
 import sys
+import tempfile
 import unittest
+import zipfile
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.dirname(test_dir)
@@ -134,5 +137,129 @@ class TestCommon(unittest.TestCase):
         self.assertEqual(logger._prints.call_count, 2)
 
 
+class TestConversionCache(unittest.TestCase):
+    def setUp(self):  # type: () -> None
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = common.ConversionCache(os.path.join(self.tmpdir, "cache"))
+
+    def tearDown(self):  # type: () -> None
+        shutil.rmtree(self.tmpdir)
+
+    def write_file(self, name, data):  # type: (str, bytes) -> str
+        path = os.path.join(self.tmpdir, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_key(self):  # type: () -> None
+        book = self.write_file("book.epub", b"book")
+        key = self.cache.key(book, {"hyphenate": True, "smarten_punctuation": False})
+
+        self.assertEqual(
+            key,
+            self.cache.key(book, {"smarten_punctuation": False, "hyphenate": True}),
+        )
+        self.assertNotEqual(
+            key,
+            self.cache.key(book, {"hyphenate": False, "smarten_punctuation": False}),
+        )
+        other = self.write_file("other.epub", b"other book")
+        self.assertNotEqual(
+            key,
+            self.cache.key(other, {"hyphenate": True, "smarten_punctuation": False}),
+        )
+        with mock.patch.object(common, "PLUGIN_VERSION", (0, 0, 1)):
+            self.assertNotEqual(
+                key,
+                self.cache.key(book, {"hyphenate": True, "smarten_punctuation": False}),
+            )
+        with mock.patch.object(common, "numeric_version", (0, 0, 1)):
+            self.assertNotEqual(
+                key,
+                self.cache.key(book, {"hyphenate": True, "smarten_punctuation": False}),
+            )
+
+    def test_fetch_and_store(self):  # type: () -> None
+        dest = self.write_file("book.epub", b"book")
+        self.assertFalse(self.cache.fetch("key", dest))
+
+        self.cache.store("key", self.write_file("converted.epub", b"converted"))
+        self.assertTrue(self.cache.fetch("key", dest))
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(), b"converted")
+
+        self.assertEqual(self.cache.stats["misses"], 1)
+        self.assertEqual(self.cache.stats["hits"], 1)
+        self.assertEqual(self.cache.stats["stores"], 1)
+        self.cache.reset_stats()
+        self.assertEqual(self.cache.stats["hits"], 0)
+
+        self.cache.clear()
+        self.assertFalse(self.cache.fetch("key", dest))
+
+    def test_evicts_least_recently_used(self):  # type: () -> None
+        self.cache.limit = 20
+        converted = self.write_file("converted.epub", b"0123456789")
+        dest = os.path.join(self.tmpdir, "dest.epub")
+
+        self.cache.store("first", converted)
+        self.cache.store("second", converted)
+        entries = os.path.join(self.cache.path, "{0}.epub")
+        os.utime(entries.format("first"), (0, 0))
+        os.utime(entries.format("second"), (1, 1))
+        # Using the oldest entry makes the other one the least recently used
+        self.assertTrue(self.cache.fetch("first", dest))
+
+        self.cache.store("third", converted)
+        self.assertEqual(self.cache.stats["evictions"], 1)
+        self.assertTrue(self.cache.fetch("first", dest))
+        self.assertFalse(self.cache.fetch("second", dest))
+        self.assertTrue(self.cache.fetch("third", dest))
+
+
+class TestAssetCache(unittest.TestCase):
+    def setUp(self):  # type: () -> None
+        self.tmpdir = tempfile.mkdtemp()
+        self.reference = os.path.join(self.tmpdir, "reference.kepub.epub")
+        patcher = mock.patch.object(common, "REFERENCE_KEPUB", self.reference)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.assets = common.AssetCache()
+
+    def tearDown(self):  # type: () -> None
+        shutil.rmtree(self.tmpdir)
+
+    def write_reference(self, kobo_js, mtime):  # type: (bytes, int) -> None
+        with zipfile.ZipFile(self.reference, "w") as zf:
+            zf.writestr("js/kobo.js", kobo_js)
+        os.utime(self.reference, (mtime, mtime))
+
+    def test_kobo_js(self):  # type: () -> None
+        self.assertIsNone(self.assets.kobo_js())
+        self.assertEqual(self.assets.kobo_js_hash(), "")
+
+        self.write_reference(b"var kobo = 1;", 1)
+        self.assertEqual(self.assets.kobo_js(), b"var kobo = 1;")
+        with mock.patch.object(zipfile, "ZipFile") as zip_file:
+            self.assertEqual(self.assets.kobo_js(), b"var kobo = 1;")
+            zip_file.assert_not_called()
+
+        self.write_reference(b"var kobo = 2;", 2)
+        self.assertEqual(self.assets.kobo_js(), b"var kobo = 2;")
+
+    def test_hyphenation_css(self):  # type: () -> None
+        template = b"{hyphen_min_chars} {hyphen_min_chars_before} "
+        template += b"{hyphen_min_chars_after} {hyphen_limit_lines}"
+        with mock.patch.object(
+            common, "get_resources", return_value=template, create=True
+        ) as get_resources:
+            self.assertEqual(self.assets.hyphenation_css(6, 3, 3, 2), b"6 3 3 2")
+            self.assertEqual(self.assets.hyphenation_css(6, 3, 3, 2), b"6 3 3 2")
+            self.assertEqual(
+                self.assets.hyphenation_css(8, 3, 3, "no-limit"), b"8 3 3 no-limit"
+            )
+        get_resources.assert_called_once_with("css/hyphenation.css.tmpl")
+
+
 if __name__ == "__main__":
     unittest.main(module="test_common", verbosity=2)
@@ -9,10 +9,15 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import unittest
 import warnings
+import zipfile
+import zlib
 
 from collections import defaultdict
+from io import BytesIO
 from lxml import etree
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
@@ -268,6 +273,733 @@ class TestContainer(TestAssertions):
             )
         )
 
+    def test_content_passes(self):
+        html_container_name = self.container.copy_file_to_container(
+            self.files["test_without_spans"]
+        )
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+
+        self.container.queue_content_pass("forced_cleanup")
+        self.container.queue_content_pass(
+            "add_content_file_reference", css_container_name
+        )
+        self.container.queue_content_pass("add_kobo_spans")
+        self.container.queue_content_pass("add_kobo_divs")
+        self.container.run_content_passes()
+
+        # Each file is written as soon as it is done, and its tree dropped
+        self.assertNotIn(html_container_name, self.container.dirtied)
+        self.assertNotIn(html_container_name, self.container.parsed_cache)
+
+        html = self.container.parsed(html_container_name)
+        for xpath, expected_count in (
+            ('count(//xhtml:span[@class="koboSpan"])', 5),
+            ('count(//xhtml:div[@id="book-columns"])', 1),
+            ('count(//xhtml:div[@id="book-inner"])', 1),
+            (
+                'count(//xhtml:head/xhtml:link[@href="{0}"])'.format(
+                    css_container_name
+                ),
+                1,
+            ),
+        ):
+            self.assertEqual(
+                html.xpath(xpath, namespaces={"xhtml": container.XHTML_NAMESPACE}),
+                expected_count,
+            )
+
+        # Queued passes only run once
+        self.container.run_content_passes()
+        html = self.container.parsed(html_container_name)
+        self.assertEqual(
+            html.xpath(
+                'count(//xhtml:div[@id="book-inner"])',
+                namespaces={"xhtml": container.XHTML_NAMESPACE},
+            ),
+            1,
+        )
+
+    def test_flush_once_per_stage(self):
+        container_names = [
+            self.container.copy_file_to_container(
+                self.files["test_without_spans"], name=f"page_{idx}.html"
+            )
+            for idx in range(5)
+        ]
+        self.container.flush_cache()
+        self.assertSetEqual(self.container.dirtied, set())
+        serializations = self.container.stats["serializations"]
+
+        self.container.smarten_punctuation()
+
+        self.assertSetEqual(self.container.dirtied, set())
+        self.assertEqual(
+            self.container.stats["serializations"] - serializations,
+            len(container_names),
+        )
+
+    def test_parsed_cache_limit(self):
+        self.container.parsed_cache_limit = 1
+        container_names = [
+            self.container.copy_file_to_container(
+                self.files["test_without_spans"], name=f"page_{idx}.html"
+            )
+            for idx in range(3)
+        ]
+        # Trees which were never written are never dropped
+        for name in container_names:
+            self.container.replace(name, self.container.parsed(name))
+        self.assertEqual(self.container.stats["evictions"], 0)
+
+        # Written trees are dropped, leaving only the most recently used one
+        self.container.flush_cache()
+        self.assertGreater(self.container.stats["evictions"], 0)
+        cached_names = [
+            name for name in container_names if name in self.container.parsed_cache
+        ]
+        self.assertEqual(len(cached_names), 1)
+
+        evictions = self.container.stats["evictions"]
+        reparses = self.container.stats["reparses"]
+        cached_html = self.container.parsed_cache[cached_names[0]]
+        evicted_name = next(
+            name for name in container_names if name not in cached_names
+        )
+        html = self.container.parsed(evicted_name)
+        self.assertEqual(self.container.stats["reparses"], reparses + 1)
+        self.assertEqual(self.container.stats["evictions"], evictions + 1)
+        self.assertEqual(etree.tostring(html), etree.tostring(cached_html))
+
+    def test_parsed_cache_limit_keeps_trees_in_use(self):
+        self.container.parsed_cache_limit = 1
+        container_names = [
+            self.container.copy_file_to_container(
+                self.files["test_without_spans"], name=f"page_{idx}.html"
+            )
+            for idx in range(3)
+        ]
+        for name in container_names:
+            self.container.parsed(name)
+            self.container.dirty(name)
+        self.container.flush_cache()
+
+        # A tree handed out by parsed() is being changed until it is marked
+        # dirty, so filling the cache meanwhile must not drop it
+        edited_name = container_names[0]
+        html = self.container.parsed(edited_name)
+        head = html.xpath(
+            "//xhtml:head", namespaces={"xhtml": container.XHTML_NAMESPACE}
+        )[0]
+        etree.SubElement(head, f"{{{container.XHTML_NAMESPACE}}}meta", name="edited")
+        for name in container_names[1:]:
+            self.container.parsed(name)
+        self.assertIs(self.container.parsed_cache[edited_name], html)
+        self.container.dirty(edited_name)
+        self.container.commit_item(edited_name)
+
+        self.assertIn('name="edited"', self.container.raw_data(edited_name))
+
+    def test_add_content_file_references(self):
+        html_container_name = self.container.copy_file_to_container(
+            self.files["test_without_spans"]
+        )
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+        js_container_name = self.container.copy_file_to_container(self.files["js"])
+
+        with mock.patch.object(
+            self.container, "flush_cache", wraps=self.container.flush_cache
+        ) as flush_cache:
+            self.container.add_content_file_references(
+                [css_container_name, js_container_name]
+            )
+        flush_cache.assert_called_once_with()
+
+        head = self.container.parsed(html_container_name).xpath(
+            "//xhtml:head", namespaces={"xhtml": container.XHTML_NAMESPACE}
+        )[0]
+        self.assertEqual(
+            [(child.get("href"), child.get("src")) for child in head[-2:]],
+            [(css_container_name, None), (None, js_container_name)],
+        )
+
+        with self.assertRaises(ValueError):
+            self.container.add_content_file_references(
+                [css_container_name, "not_a_file.css"]
+            )
+
+    def test_streaming_content_passes(self):
+        source_file = os.path.join(self.testfile_basedir, "page_github_106.html")
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+        js_container_name = self.container.copy_file_to_container(self.files["js"])
+        with open(source_file, "rb") as f:
+            data = f.read()
+        passes = [
+            ("forced_cleanup", ()),
+            ("add_content_file_reference", (css_container_name, js_container_name)),
+            ("add_kobo_spans", ()),
+            ("add_kobo_divs", ()),
+        ]
+
+        results = []
+        for streaming_threshold in (len(data), 0):
+            self.container.paragraph_counter = {}
+            self.container.streaming_threshold = streaming_threshold
+            root = etree.fromstring(
+                self.container._transform_content_data("page.html", data, passes)
+            )
+            results.append(
+                (
+                    root.xpath(
+                        '//xhtml:span[@class="koboSpan"]/@id',
+                        namespaces={"xhtml": container.XHTML_NAMESPACE},
+                    ),
+                    root.xpath(
+                        'count(//xhtml:body/xhtml:div[@id="book-columns"]'
+                        + '/xhtml:div[@id="book-inner"])',
+                        namespaces={"xhtml": container.XHTML_NAMESPACE},
+                    ),
+                    root.xpath(
+                        "count(//xhtml:head/xhtml:link)",
+                        namespaces={"xhtml": container.XHTML_NAMESPACE},
+                    ),
+                    root.xpath(
+                        "count(//xhtml:head/xhtml:script)",
+                        namespaces={"xhtml": container.XHTML_NAMESPACE},
+                    ),
+                    self.container.paragraph_counter["page.html"],
+                )
+            )
+        self.assertEqual(self.container.stats["streamed"], 1)
+        self.assertGreater(len(results[0][0]), 0)
+        self.assertEqual(results[0][3], 1)
+        self.assertEqual(results[0], results[1])
+
+    def transform_both_ways(self, data, passes):
+        """Run content passes over data in memory and streaming, in that order."""
+        results = []
+        for streaming_threshold in (len(data), 0):
+            self.container.paragraph_counter = {}
+            self.container.streaming_threshold = streaming_threshold
+            results.append(
+                self.container._transform_content_data("page.html", data, passes)
+            )
+        return results
+
+    def test_streamed_content_matches_parsed_content(self):
+        data = (
+            '<?xml version="1.0" encoding="utf-8"?>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml">\n'
+            "<head><title>Page</title>"
+            '<meta http-equiv="Content-Type" content="text/html; charset=utf-8"/>'
+            "</head>\n"
+            "<body>\n"
+            "<!-- A comment -->\n"
+            "<p>First line<br/>second line</p>\n"
+            '<p><img src="cover.jpg" alt="Cover"/> after the image</p>\n'
+            "<hr/>\n"
+            "<p></p>\n"
+            "<div><p>Nested <em>text</em> here.</p><p>And more.</p></div>\n"
+            "</body>\n"
+            "</html>\n"
+        ).encode("utf-8")
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+        for passes in (
+            [("add_kobo_spans", ())],
+            [("add_kobo_spans", ()), ("add_kobo_divs", ())],
+            [
+                ("forced_cleanup", ()),
+                ("add_content_file_reference", (css_container_name,)),
+                ("add_kobo_spans", ()),
+                ("add_kobo_divs", ()),
+            ],
+        ):
+            with self.subTest(passes=passes):
+                streamed = self.container.stats["streamed"]
+                parsed_data, streamed_data = self.transform_both_ways(data, passes)
+                self.assertEqual(self.container.stats["streamed"], streamed + 1)
+                self.assertIn(b"koboSpan", streamed_data)
+                self.assertEqual(parsed_data, streamed_data)
+
+    def test_unstreamable_content_is_parsed(self):
+        passes = [("smarten_punctuation", ()), ("add_kobo_spans", ())]
+        for data in (
+            # No XHTML namespace
+            b"<html><head><title>Page</title></head>"
+            b"<body><p>Some text.</p></body></html>",
+            # Entities only defined in HTML
+            b'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Page'
+            b"</title></head><body><p>Wait&hellip; what?</p></body></html>",
+            # Namespaces declared below the root
+            b'<html xmlns="http://www.w3.org/1999/xhtml"><head><title>Page'
+            b'</title></head><body><p xmlns:epub="http://www.idpf.org/2007/ops">'
+            b"Some text.</p></body></html>",
+        ):
+            with self.subTest(data=data):
+                parsed_data, streamed_data = self.transform_both_ways(data, passes)
+                self.assertNotIn("streamed", self.container.stats)
+                self.assertIn(b"koboSpan", streamed_data)
+                self.assertEqual(parsed_data, streamed_data)
+
+    def memory_container(self, tmpdir, **kwargs):
+        """Open the reference book plus a content file with the memory backend."""
+        epub = BytesIO()
+        with zipfile.ZipFile(epub, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for name in (
+                "META-INF/container.xml",
+                "content.opf",
+                "toc.ncx",
+                "cover.jpg",
+            ):
+                zf.write(os.path.join(self.reference_book, name), name)
+            zf.write(self.files["test_without_spans"], "page.html")
+        opf = etree.fromstring(zipfile.ZipFile(epub).read("content.opf"))
+        manifest = opf.find("{http://www.idpf.org/2007/opf}manifest")
+        etree.SubElement(
+            manifest,
+            "{http://www.idpf.org/2007/opf}item",
+            {"id": "page", "href": "page.html", "media-type": "application/xhtml+xml"},
+        )
+        os.mkdir(tmpdir)
+        kepub = container.KEPubContainer(
+            epub.getvalue(), self.log, tdir=tmpdir, fused=True, **kwargs
+        )
+        kepub.replace(kepub.opf_name, opf)
+        return epub, kepub
+
+    def test_memory_backend(self):
+        tmpdir = os.path.join(self.basedir, "memory")
+        epub, kepub = self.memory_container(tmpdir)
+        css_container_name = kepub.copy_file_to_container(self.files["css"])
+        self.assertEqual(kepub.mime_map["page.html"], "application/xhtml+xml")
+        kepub.queue_content_pass("add_content_file_reference", css_container_name)
+        kepub.queue_content_pass("add_kobo_spans")
+        kepub.run_content_passes()
+
+        # Nothing is extracted to the root directory, and only the files used
+        # so far (container.xml, the OPF and the content file) were read
+        self.assertEqual(os.listdir(tmpdir), [])
+        self.assertEqual(kepub.stats["extractions"], 3)
+        self.assertEqual(
+            kepub.filesize("cover.jpg"),
+            os.path.getsize(os.path.join(self.reference_book, "cover.jpg")),
+        )
+        self.assertEqual(kepub.stats["extractions"], 3)
+
+        output = BytesIO()
+        kepub.commit(output)
+        # container.xml, toc.ncx and the cover are copied without recompressing
+        self.assertEqual(kepub.stats["copied"], 3)
+        self.assertEqual(kepub.stats["extractions"], 3)
+        with zipfile.ZipFile(output) as zf:
+            self.assertIsNone(zf.testzip())
+            infos = zf.infolist()
+            self.assertEqual(infos[0].filename, "mimetype")
+            self.assertEqual(infos[0].compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(zf.read("mimetype"), b"application/epub+zip")
+            original = zipfile.ZipFile(epub).getinfo("cover.jpg")
+            copy = zf.getinfo("cover.jpg")
+            self.assertEqual(copy.CRC, original.CRC)
+            self.assertEqual(copy.compress_size, original.compress_size)
+            self.assertIn(css_container_name, zf.namelist())
+            page = zf.read("page.html").decode("utf-8")
+        self.assertIn('class="koboSpan"', page)
+        self.assertIn(css_container_name, page)
+        self.assertEqual(kepub.raw_data("page.html"), page)
+        with open(os.path.join(self.reference_book, "cover.jpg"), "rb") as f:
+            self.assertEqual(kepub.raw_data("cover.jpg"), f.read())
+
+    def test_memory_backend_without_raw_members(self):
+        tmpdir = os.path.join(self.basedir, "public")
+        epub, kepub = self.memory_container(tmpdir)
+        kepub.add_kobo_spans("page.html")
+        output = BytesIO()
+        with mock.patch.object(container, "RAW_MEMBER_PYTHON_VERSIONS", ((3, 0),) * 2):
+            kepub.commit(output)
+
+        # Every file is recompressed with zipfile instead of being copied
+        self.assertEqual(kepub.stats["copied"], 0)
+        with zipfile.ZipFile(output) as zf, zipfile.ZipFile(epub) as original:
+            self.assertIsNone(zf.testzip())
+            self.assertEqual(zf.namelist()[0], "mimetype")
+            self.assertEqual(zf.read("cover.jpg"), original.read("cover.jpg"))
+            self.assertIn('class="koboSpan"', zf.read("page.html").decode("utf-8"))
+
+    def test_memory_backend_compares_written_data(self):
+        tmpdir = os.path.join(self.basedir, "written")
+        epub, kepub = self.memory_container(tmpdir)
+        original = kepub.raw_data("cover.jpg", decode=False)
+        changed = bytes(reversed(original))
+        # A file with the size and CRC of its member but other data is changed
+        store = kepub._KEPubContainer__store
+        store._ContainerMemberStore__infos["cover.jpg"].CRC = zlib.crc32(changed)
+        with kepub.open("cover.jpg", "wb") as f:
+            f.write(changed)
+        output = BytesIO()
+        kepub.commit(output)
+        with zipfile.ZipFile(output) as zf:
+            self.assertEqual(zf.read("cover.jpg"), changed)
+
+    def test_compression_policies(self):
+        with self.assertRaises(ValueError):
+            container.KEPubContainer(
+                self.epub_dir, self.log, tdir=self.tmpdir, compression="unknown"
+            )
+
+        compress_types = {}
+        for policy in sorted(container.COMPRESSION_POLICIES):
+            _epub, kepub = self.memory_container(
+                os.path.join(self.basedir, policy), compression=policy
+            )
+            image = kepub.copy_file_to_container(
+                os.path.join(self.reference_book, "cover.jpg"), name="image.jpg"
+            )
+            kepub.add_kobo_spans("page.html")
+            output = BytesIO()
+            kepub.commit(output)
+            with zipfile.ZipFile(output) as zf:
+                self.assertIsNone(zf.testzip())
+                compress_types[policy] = (
+                    zf.getinfo("page.html").compress_type,
+                    zf.getinfo(image).compress_type,
+                )
+            self.assertEqual(kepub.stats["copied"], 3)
+            self.assertEqual(kepub.stats["compressed"] + kepub.stats["stored"], 3)
+
+        deflated, stored = zipfile.ZIP_DEFLATED, zipfile.ZIP_STORED
+        self.assertEqual(compress_types["default"], (deflated, deflated))
+        self.assertEqual(compress_types["balanced"], (deflated, stored))
+        self.assertEqual(compress_types["fast"], (deflated, stored))
+        self.assertEqual(compress_types["smallest"], (deflated, deflated))
+
+    def test_manifest_index(self):
+        index = self.container.manifest_index()
+        self.assertIs(self.container.manifest_index(), index)
+        self.assertEqual(index.cover_id, "cover")
+        self.assertEqual(index.by_id["cover"].get("href"), "cover.jpg")
+        self.assertIs(index.by_href["cover.jpg"], index.by_id["cover"])
+        self.assertEqual(index.cover_candidates, [index.by_id["cover"]])
+        self.assertEqual(index.by_media_type["image/jpeg"], ["cover.jpg"])
+        self.assertEqual(index.spine, [])
+        self.assertEqual(list(self.container.html_names()), [])
+
+        # Adding a file changes the OPF, which drops the index
+        container_name = self.container.copy_file_to_container(
+            self.files["test_without_spans"]
+        )
+        index = self.container.manifest_index()
+        self.assertEqual(list(self.container.html_names()), [container_name])
+        self.assertEqual(index.names_of_types(["image/jpeg"]), ["cover.jpg"])
+
+        spine = self.container.opf_xpath("//opf:spine")[0]
+        spine.append(spine.makeelement(f"{{{spine.nsmap[None]}}}itemref"))
+        spine[-1].set("idref", index.by_href[container_name].get("id"))
+        self.container.dirty(self.container.opf_name)
+        self.assertEqual(self.container.manifest_index().spine, [container_name])
+
+    def test_census_tree(self):
+        namespaces = {"xhtml": container.XHTML_NAMESPACE}
+        for name in ("test_with_spans", "test_without_spans"):
+            container_name = self.container.copy_file_to_container(self.files[name])
+            root = self.container.parsed(container_name)
+            census = container._census_tree(root)
+            self.assertEqual(
+                census["kobo_spans"],
+                root.xpath(
+                    'count(.//xhtml:span[@class="koboSpan" '
+                    + 'or starts-with(@id, "kobo.")])',
+                    namespaces=namespaces,
+                ),
+            )
+            self.assertEqual(
+                census["divs"], root.xpath("count(//xhtml:div)", namespaces=namespaces)
+            )
+            self.assertEqual(
+                census["ps"], root.xpath("count(//xhtml:p)", namespaces=namespaces)
+            )
+            self.assertEqual(
+                census["kobo_divs"],
+                root.xpath(
+                    'count(//xhtml:div[@id="book-inner"])', namespaces=namespaces
+                ),
+            )
+            self.assertEqual(census["heads"], 1)
+
+    def test_content_file_reference_without_head(self):
+        css_container_name = self.container.copy_file_to_container(self.files["css"])
+        data = (
+            b'<html xmlns="http://www.w3.org/1999/xhtml">'
+            b"<body><p>Some text.</p></body></html>"
+        )
+        self.assertEqual(container._census_tree(etree.fromstring(data))["heads"], 0)
+        self.assertEqual(container._count_stream_elements(data)["heads"], 0)
+        passes = [("add_content_file_reference", (css_container_name,))]
+        for streaming_threshold in (len(data), 0):
+            with self.subTest(streaming_threshold=streaming_threshold):
+                self.container.streaming_threshold = streaming_threshold
+                with self.assertRaises(Exception) as cm:
+                    self.container._transform_content_data("page.html", data, passes)
+                self.assertIn("Could not find a <head> element", str(cm.exception))
+
+    def test_census_kept_up_to_date(self):
+        tmpdir = os.path.join(self.basedir, "census")
+        os.mkdir(tmpdir)
+        kepub = container.KEPubContainer(
+            self.epub_dir, self.log, executor=container.EXECUTOR_SERIAL, tdir=tmpdir
+        )
+        container_name = kepub.copy_file_to_container(self.files["test_without_spans"])
+        kepub.queue_content_pass("add_kobo_spans")
+        kepub.queue_content_pass("add_kobo_divs")
+        kepub.queue_content_pass("add_kobo_divs")
+        with self.assertRaises(Exception) as cm:
+            kepub.run_content_passes()
+        self.assertIn("Kobo <div> tag present", str(cm.exception))
+        self.assertIsNone(kepub.content_context(container_name).census)
+
+    def test_copy_data_to_container(self):
+        _epub, kepub = self.memory_container(os.path.join(self.basedir, "memory"))
+        for container_instance in (self.container, kepub):
+            name = container_instance.copy_data_to_container(
+                b"p { margin: 0; }", "kte-css/test.css"
+            )
+            self.assertEqual(name, "kte-css/test.css")
+            self.assertEqual(container_instance.mime_map[name], "text/css")
+            self.assertEqual(container_instance.raw_data(name), "p { margin: 0; }")
+
+    def test_transform_cache(self):
+        cache = container.TransformCache((1, 2, 3))
+        results = []
+        for run in range(2):
+            _epub, kepub = self.memory_container(
+                os.path.join(self.basedir, f"run{run}"), transform_cache=cache
+            )
+            kepub.queue_content_pass("add_kobo_spans")
+            kepub.queue_content_pass("add_kobo_divs")
+            kepub.run_content_passes()
+            results.append(
+                (kepub.raw_data("page.html"), kepub.paragraph_counter["page.html"])
+            )
+            self.assertEqual(kepub.stats["transform_misses"], 1 - run)
+            self.assertEqual(kepub.stats["transform_hits"], run)
+
+        self.assertEqual(results[0], results[1])
+        self.assertIn('class="koboSpan"', results[0][0])
+        self.assertGreater(results[0][1], 1)
+
+        # Different passes give a different result
+        _epub, kepub = self.memory_container(
+            os.path.join(self.basedir, "divs"), transform_cache=cache
+        )
+        kepub.add_kobo_divs("page.html")
+        kepub.queue_content_pass("add_kobo_spans")
+        kepub.run_content_passes()
+        self.assertEqual(kepub.stats["transform_misses"], 1)
+        self.assertEqual(cache.stats["hits"], 1)
+        self.assertEqual(cache.stats["misses"], 2)
+
+        cache.limit = len(results[0][0].encode("utf-8"))
+        cache.put("other", b"other", 1)
+        self.assertEqual(cache.stats["evictions"], 2)
+        self.assertEqual(cache.get("other"), (b"other", 1))
+
+    def test_classify_media_type(self):
+        for media_type, expected in (
+            ("application/xhtml+xml", "markup"),
+            ("text/css", "markup"),
+            ("image/svg+xml", "markup"),
+            ("application/x-dtbncx+xml", "markup"),
+            ("image/jpeg", "media"),
+            ("audio/mpeg", "media"),
+            ("font/woff2", "font"),
+            ("application/x-font-ttf", "font"),
+            ("application/vnd.ms-opentype", "font"),
+            ("application/octet-stream", "other"),
+            (None, "other"),
+        ):
+            self.assertEqual(container.classify_media_type(media_type), expected)
+
+    def test_content_pass_executors(self):
+        results = {}
+        for executor in sorted(container.EXECUTORS):
+            tmpdir = os.path.join(self.basedir, executor)
+            os.mkdir(tmpdir)
+            kepub = container.KEPubContainer(
+                self.epub_dir, self.log, executor=executor, tdir=tmpdir
+            )
+            container_name = kepub.copy_file_to_container(
+                self.files["test_without_spans"]
+            )
+            kepub.queue_content_pass("forced_cleanup")
+            kepub.queue_content_pass("add_kobo_spans")
+            kepub.queue_content_pass("add_kobo_divs")
+            kepub.run_content_passes()
+            results[executor] = (
+                kepub.raw_data(container_name),
+                kepub.paragraph_counter[container_name],
+            )
+
+        self.assertEqual(len(set(results.values())), 1)
+        self.assertIn('id="kobo.1.1"', results[container.EXECUTOR_SERIAL][0])
+        self.assertRaises(
+            ValueError,
+            container.KEPubContainer,
+            self.epub_dir,
+            self.log,
+            executor="not_an_executor",
+        )
+
+    def test_process_executor_only_on_linux(self):
+        for platform, expected in (
+            ("linux", container.EXECUTOR_PROCESS),
+            ("darwin", container.EXECUTOR_THREAD),
+            ("win32", container.EXECUTOR_THREAD),
+        ):
+            tmpdir = os.path.join(self.basedir, platform)
+            os.mkdir(tmpdir)
+            with mock.patch.object(container.sys, "platform", platform):
+                kepub = container.KEPubContainer(
+                    self.epub_dir,
+                    self.log,
+                    executor=container.EXECUTOR_PROCESS,
+                    tdir=tmpdir,
+                )
+            self.assertEqual(kepub.executor, expected)
+
+    def test_content_context(self):
+        context = self.container.content_context("test")
+        self.assertIs(self.container.content_context("test"), context)
+        self.assertEqual(context.paragraph, 1)
+        context.paragraph = 5
+        self.assertEqual(self.container.paragraph_counter["test"], 5)
+        self.assertEqual(self.container.paragraph_counter["other"], 1)
+
+        self.container.paragraph_counter = {"other": 3}
+        self.assertEqual(self.container.content_context("test").paragraph, 1)
+        self.assertEqual(self.container.content_context("other").paragraph, 3)
+
+        # The encoding detected while decoding is tracked per thread
+        self.container.used_encoding = "utf-8"
+        encodings = []
+        thread = threading.Thread(
+            target=lambda: encodings.append(self.container.used_encoding)
+        )
+        thread.start()
+        thread.join()
+        self.assertListEqual(encodings, [None])
+        self.assertEqual(self.container.used_encoding, "utf-8")
+
+    def test_unknown_content_pass(self):
+        self.assertRaises(ValueError, self.container.queue_content_pass, "not_a_pass")
+        self.assertRaises(
+            ValueError,
+            self.container.queue_content_pass,
+            "add_content_file_reference",
+            "not_a_file.css",
+        )
+
+    def test_worker_pool(self):
+        pool = container.ContentWorkerPool()
+        try:
+            results = pool.run(
+                lambda name, value: (name, value * 2),
+                [(("task{0}".format(i), i), 10.0) for i in range(20)],
+            )
+            self.assertListEqual(
+                results, [("task{0}".format(i), i * 2) for i in range(20)]
+            )
+            self.assertListEqual(pool.run(lambda name: name, []), [])
+            self.assertRaises(
+                container.TimeoutError,
+                pool.run,
+                lambda name: time.sleep(1),
+                [(("slow_task",), 0.1)],
+            )
+        finally:
+            pool.shutdown()
+
+    def test_worker_pool_time_budget_shared(self):
+        def busy(name):
+            end = time.thread_time() + 0.2
+            while time.thread_time() < end:
+                pass
+            return name
+
+        # Eight tasks sharing the GIL take far longer than their budget in
+        # elapsed time, but each only uses its share of it
+        pool = container.ContentWorkerPool()
+        try:
+            names = [f"task{i}" for i in range(8)]
+            self.assertListEqual(
+                pool.run(busy, [((name,), 0.5) for name in names]), names
+            )
+        finally:
+            pool.shutdown()
+
+    def test_worker_pool_cancels_timed_out_tasks(self):
+        cancelled = []
+
+        def slow(name):
+            time.sleep(0.5)
+            try:
+                container.check_task_cancelled()
+            except container.TaskCancelled:
+                cancelled.append(name)
+
+        pool = container.ContentWorkerPool()
+        try:
+            with self.assertRaises(container.TimeoutError) as cm:
+                pool.run(slow, [(("slow_task",), 0.1)])
+            self.assertListEqual(cm.exception.unfinished, ["slow_task"])
+        finally:
+            pool.shutdown()
+        self.assertListEqual(cancelled, ["slow_task"])
+
+    def test_timed_out_task_changes_dropped(self):
+        container_name = self.container.copy_file_to_container(
+            self.files["test_without_spans"]
+        )
+        add_kobo_spans = self.container._add_kobo_spans_to_node
+
+        def slow_add_kobo_spans(*args):
+            time.sleep(0.5)
+            return add_kobo_spans(*args)
+
+        with mock.patch.object(
+            self.container, "_add_kobo_spans_to_node", side_effect=slow_add_kobo_spans
+        ), mock.patch.object(
+            self.container, "_KEPubContainer__time_budget", return_value=0.1
+        ):
+            self.container.queue_content_pass("add_kobo_spans")
+            with self.assertRaises(container.TimeoutError):
+                self.container.run_content_passes()
+            # Let the task run out, trying to store its changes
+            time.sleep(1)
+
+        self.assertNotIn(container_name, self.container.dirtied)
+        self.assertNotIn('class="koboSpan"', self.container.raw_data(container_name))
+
+    def test_longest_first_scheduling(self):
+        names = [
+            self.container.copy_file_to_container(self.files[key])
+            for key in ("dirty_markup", "test_without_spans", "needs_cleanup")
+        ]
+        sizes = {
+            name: os.path.getsize(self.container.name_path_map[name]) for name in names
+        }
+
+        scheduled = []
+        run = container.worker_pool.run
+
+        def record(func, tasks, processes=False):
+            scheduled.append([args[0] for args, _budget in tasks])
+            return run(func, tasks, processes=processes)
+
+        with mock.patch.object(container.worker_pool, "run", side_effect=record):
+            self.container.smarten_punctuation()
+
+        self.assertListEqual(
+            scheduled[0], sorted(names, key=lambda name: sizes[name], reverse=True)
+        )
+
     def test_add_spans_to_text(self):
         text_samples = [
             "Hello, World!",
@@ -301,6 +1033,85 @@ class TestContainer(TestAssertions):
                 )
                 self.assertEqual(span.text, text)
 
+    def test_add_spans_to_deeply_nested_node(self):
+        self.container.paragraph_counter = defaultdict(lambda: 1)
+        node = etree.Element("{{{0}}}div".format(container.XHTML_NAMESPACE))
+        leaf = node
+        for _ in range(sys.getrecursionlimit() + 100):
+            leaf = etree.SubElement(
+                leaf, "{{{0}}}span".format(container.XHTML_NAMESPACE)
+            )
+            leaf.tail = "Tail."
+        leaf.text = "Text."
+
+        node = self.container._add_kobo_spans_to_node(node, "test")
+        spans = node.xpath(
+            '//xhtml:span[@class="koboSpan"]',
+            namespaces={"xhtml": container.XHTML_NAMESPACE},
+        )
+        self.assertEqual(len(spans), sys.getrecursionlimit() + 101)
+        self.assertEqual(spans[0].text, "Text.")
+        self.assertEqual(spans[0].get("id"), "kobo.1.1")
+        self.assertEqual(spans[-1].get("id"), "kobo.{0}.1".format(len(spans)))
+
+    def test_classify_tag(self):
+        for tag, expected in (
+            ("{{{0}}}p".format(container.XHTML_NAMESPACE), container.TAG_DESCEND),
+            ("{{{0}}}img".format(container.XHTML_NAMESPACE), container.TAG_WRAP),
+            ("{http://www.w3.org/2000/svg}svg", container.TAG_SKIP),
+            ("pre", container.TAG_SKIP),
+            ("custom-element", container.TAG_DESCEND),
+        ):
+            self.assertEqual(container.classify_tag(tag), expected)
+            # Classifications are cached
+            self.assertEqual(container.classify_tag(tag), expected)
+
+    def test_sentence_segmenter(self):
+        for text in [
+            "Hello, World!",
+            "\n\n    GIF is pronounced as it's spelled.\n   ",
+            "\n  All rights reserved.\nAll wrongs on retainer.\n  ",
+            'He said: "No!" Then he left\u2026 and never came back',
+            "Copyright",
+        ]:
+            self.assertListEqual(
+                container.DEFAULT_SEGMENTER.split(text),
+                [g for g in container.TEXT_SPLIT_RE.split(text) if g != ""],
+            )
+        self.assertListEqual(container.DEFAULT_SEGMENTER.split(""), [])
+        texts = ["One. Two", "", "three", "Four? Five!\n", " six. "]
+        self.assertListEqual(
+            container.DEFAULT_SEGMENTER.split_texts(texts),
+            [container.DEFAULT_SEGMENTER.split(text) for text in texts],
+        )
+        # Long runs without a terminator must not backtrack
+        self.assertListEqual(
+            container.DEFAULT_SEGMENTER.split("a" * 100000), ["a" * 100000]
+        )
+
+        self.assertIs(self.container.segmenter, container.segmenter_for_language("en"))
+        for language in ["en", "en-US", "eng", "EN_gb"]:
+            self.assertListEqual(
+                container.segmenter_for_language(language).split(
+                    "Mr. Smith paid 3.50 dollars, i.e. too much. He left."
+                ),
+                ["Mr. Smith paid 3.50 dollars, i.e. too much. ", "He left."],
+            )
+        self.assertListEqual(
+            container.segmenter_for_language("de").split("Das ist z.B. ein Test. Ja."),
+            ["Das ist z.B. ein Test. ", "Ja."],
+        )
+        self.assertListEqual(
+            container.segmenter_for_language("ja").split(
+                "\u3053\u308c\u306f\u6587\u3002\u6587\uff01"
+            ),
+            ["\u3053\u308c\u306f\u6587\u3002", "\u6587\uff01"],
+        )
+        for language in [None, "", "xx"]:
+            self.assertIs(
+                container.segmenter_for_language(language), container.DEFAULT_SEGMENTER
+            )
+
     def __run_multiple_node_test(self, text_nodes):  # type: (List[str]) -> None
         html = "<div>"
         for text in text_nodes:
@@ -3,6 +3,7 @@
 # To import from calibre, some things need to be added to `sys` first. Do not import
 # anything from calibre or the plugins yet.
 import glob
+import json
 import os
 import shutil
 import sys
@@ -10,6 +11,7 @@ import tempfile
 import unittest
 import uuid
 import warnings
+import zipfile
 
 test_dir = os.path.dirname(os.path.abspath(__file__))
 src_dir = os.path.dirname(test_dir)
@@ -136,6 +138,66 @@ class TestDeviceWithExtendedFeatures(DeviceTestBase):
 
         self.assertNotIn(self.mi.uuid, self.device.skip_renaming_files)
 
+    @mock.patch.object(driver.common, "modify_epub")
+    @mock.patch.object(driver.KOBOTOUCH, "_modify_epub", return_value=True)
+    def test_modify_epub_commits_once(self, _base_modify_epub, _modify_epub):
+        with mock.patch.object(self.container, "commit") as commit:
+            self.assertTrue(
+                self.device._modify_epub("test.epub", self.mi, self.container)
+            )
+
+        self.assertFalse(_modify_epub.call_args[1]["commit"])
+        _base_modify_epub.assert_called_once_with("test.epub", self.mi, self.container)
+        commit.assert_called_once_with(outpath="test.epub")
+
+    @mock.patch.object(driver.KOBOTOUCHEXTENDED, "cache_conversions", True)
+    def test_modify_epub_cache_hit_adds_driver_info(self):
+        book = os.path.join(self.basedir, "book.epub")
+        converted = os.path.join(self.basedir, "converted.epub")
+        for path in (book, converted):
+            with zipfile.ZipFile(path, "w") as zf:
+                for name in (
+                    "META-INF/container.xml",
+                    "content.opf",
+                    "toc.ncx",
+                    "cover.jpg",
+                ):
+                    zf.write(os.path.join(self.reference_book, name), name)
+        converted_container = container.KEPubContainer(
+            converted, self.log, backend=container.BACKEND_MEMORY, tdir=self.tmpdir
+        )
+        converted_container.copy_file_to_container(
+            os.path.join(test_dir, "test_files", "page_without_spans.html"),
+            name="page.html",
+            mt="application/xhtml+xml",
+        )
+        converted_container.copy_data_to_container(
+            b"{}", driver.DRIVER_INFO_NAME, mt="application/json"
+        )
+        converted_container.commit(outpath=converted)
+
+        containers = []
+
+        def open_container(*args, **kwargs):
+            containers.append(container.KEPubContainer(*args, **kwargs))
+            return containers[-1]
+
+        cache = driver.common.ConversionCache(os.path.join(self.basedir, "cache"))
+        with mock.patch.object(driver, "conversion_cache", cache):
+            cache.store(cache.key(book, {}), converted)
+            with mock.patch.object(
+                self.device, "conversion_fingerprint", return_value={}
+            ), mock.patch.object(driver, "KEPubContainer", side_effect=open_container):
+                self.assertTrue(self.device._modify_epub(book, self.mi))
+
+        self.assertEqual(cache.stats["hits"], 1)
+        # Only the driver info is replaced, the content files aren't converted
+        self.assertEqual(len(containers), 1)
+        self.assertEqual(containers[0].stats["serializations"], 0)
+        with zipfile.ZipFile(book) as zf:
+            driver_info = json.loads(zf.read(driver.DRIVER_INFO_NAME))
+        self.assertIn("kobotouchextended_currenttime", driver_info)
+
 
 @mock.patch.object(driver.KOBOTOUCHEXTENDED, "extra_features", False)
 class TestDeviceWithoutExtendedFeatures(DeviceTestBase):